@@ -0,0 +1,165 @@
+"""
+Compressed archive of sealed days of readings.
+
+Once a day is old enough (ARCHIVE_AFTER), its readings are moved from the
+readings table into one block per location. Like in Gorilla, timestamps
+are stored as delta-of-deltas and values as the XOR with the previous
+value; both are mostly zero bits for regular, slowly changing series.
+Instead of bit packing, the arrays are compressed with zlib (the repeating
+XOR patterns of quantized sensor values compress well that way), so a block
+is decoded with a handful of vectorized NumPy operations.
+"""
+
+import struct
+import zlib
+
+import numpy
+
+from sqlalchemy import Table, Column, Integer, String, LargeBinary, UniqueConstraint
+
+import rollup
+
+DAY = 86400
+
+# Number of readings and the first timestamp
+HEADER = struct.Struct('<Iq')
+
+def define_tables(metadata):
+    """
+    Registers the archive table in the metadata.
+    Readings without location are stored with an empty location.
+    """
+
+    Table('archive', metadata,
+        Column('day', Integer, nullable=False),
+        Column('location', String, nullable=False, default=''),
+        Column('count', Integer, nullable=False),
+        Column('data', LargeBinary, nullable=False),
+        UniqueConstraint('day', 'location'))
+
+def encode(timestamps, values):
+    """ Encodes the timestamps and values (sorted by time) into a block """
+
+    timestamps = numpy.asarray(timestamps, dtype = numpy.int64)
+    bits = numpy.asarray(values, dtype = numpy.float64).view(numpy.uint64)
+
+    deltas = numpy.diff(timestamps)
+    dods = numpy.diff(numpy.r_[numpy.int64(0), deltas])
+
+    xors = bits ^ numpy.r_[numpy.uint64(0), bits[:-1]]
+
+    return HEADER.pack(len(timestamps), timestamps[0]) + zlib.compress(dods.tostring() + xors.tostring(), 9)
+
+def decode(block):
+    """ Decodes the block into arrays of timestamps and values """
+
+    count, first = HEADER.unpack_from(block)
+    data = zlib.decompress(block[HEADER.size:])
+
+    dods = numpy.frombuffer(data, numpy.int64, count - 1)
+    xors = numpy.frombuffer(data, numpy.uint64, count, 8 * (count - 1))
+
+    timestamps = first + numpy.r_[numpy.int64(0), numpy.cumsum(numpy.cumsum(dods))]
+    values = numpy.bitwise_xor.accumulate(xors).view(numpy.float64)
+
+    return timestamps, values
+
+def horizon(db_session):
+    """ Returns the unix time before which the archive may hold readings, or None """
+
+    day = db_session.execute("SELECT MAX(day) FROM archive").scalar()
+
+    if day is None:
+        return None
+
+    return (day + 1) * DAY
+
+def oldest(db_session):
+    """ Returns the unix time of the start of the oldest archived day, or None """
+
+    day = db_session.execute("SELECT MIN(day) FROM archive").scalar()
+
+    if day is None:
+        return None
+
+    return day * DAY
+
+def archived(db_session, day):
+    return db_session.execute("SELECT 1 FROM archive WHERE day = :day LIMIT 1", {'day': day}).scalar() is not None
+
+def seal(db_session, day):
+    """
+    Moves the readings of the day (unix time of its start) into the archive,
+    in one transaction. Readings which arrived for an already sealed day
+    are merged into its blocks. Makes sure the rollups are complete first,
+    as they can't be rebuilt from the archive.
+    """
+
+    start, end = day, day + DAY - 1
+
+    result = db_session.execute("SELECT timestamp, value, COALESCE(location, '') AS location FROM readings WHERE (timestamp BETWEEN :start AND :end) ORDER BY location, timestamp", {'start': start, 'end': end})
+    rows = result.fetchall()
+
+    if not rows:
+        return 0
+
+    try:
+        if not archived(db_session, day / DAY):
+            rollup.backfill(db_session, start, end)
+
+        locations = {}
+
+        for r in rows:
+            locations.setdefault(r['location'], []).append((r['timestamp'], r['value']))
+
+        for location, readings in locations.items():
+            timestamps = numpy.array([r[0] for r in readings], dtype = numpy.int64)
+            values = numpy.array([r[1] for r in readings], dtype = numpy.float64)
+
+            existing = db_session.execute("SELECT data FROM archive WHERE day = :day AND location = :location", {'day': day / DAY, 'location': location}).scalar()
+
+            if existing:
+                old_timestamps, old_values = decode(existing)
+
+                timestamps = numpy.concatenate((old_timestamps, timestamps))
+                values = numpy.concatenate((old_values, values))
+
+                order = numpy.argsort(timestamps, kind = 'mergesort')
+                timestamps, values = timestamps[order], values[order]
+
+            db_session.execute("INSERT OR REPLACE INTO archive (day, location, count, data) VALUES (:day, :location, :count, :data)",
+                {'day': day / DAY, 'location': location, 'count': len(timestamps), 'data': buffer(encode(timestamps, values))})
+
+        db_session.execute("DELETE FROM readings WHERE (timestamp BETWEEN :start AND :end)", {'start': start, 'end': end})
+        db_session.commit()
+    except:
+        db_session.rollback()
+        raise
+
+    return len(rows)
+
+def read(db_session, start, end):
+    """
+    Returns the timestamps, values and locations of the archived readings
+    between start and end, oldest first.
+    """
+
+    result = db_session.execute("SELECT data, NULLIF(location, '') AS location FROM archive WHERE (day BETWEEN :start / 86400 AND :end / 86400)", {'start': start, 'end': end})
+
+    timestamps, values, locations = [], [], []
+
+    for r in result:
+        t, v = decode(str(r['data']))
+        selected = (t >= start) & (t <= end)
+
+        timestamps.append(t[selected])
+        values.append(v[selected])
+        locations.append(numpy.repeat(numpy.array([r['location']], dtype = object), selected.sum()))
+
+    if not timestamps:
+        return numpy.empty(0, numpy.int64), numpy.empty(0, numpy.float64), numpy.empty(0, object)
+
+    timestamps = numpy.concatenate(timestamps)
+    order = numpy.argsort(timestamps, kind = 'mergesort')
+
+    return timestamps[order], numpy.concatenate(values)[order], numpy.concatenate(locations)[order]
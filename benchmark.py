@@ -0,0 +1,205 @@
+"""
+Benchmarks of the ingest, query and render paths.
+
+Seeds a fresh database for every requested size and writes the results
+as JSON, so runs can be compared:
+
+    python benchmark.py --readings 10000,1000000,10000000 --locations 3 --output benchmark.json
+"""
+
+import argparse
+import json
+import math
+import random
+import time
+
+from flask import request
+
+from cache import GraphCache
+from graph import Graph
+from temperature import Temperature
+from test_utils import TestCollector
+
+import rollup
+
+DAY = 86400
+
+FORMATS = ['png', 'svg', 'pdf', 'json']
+
+class Benchmark:
+
+    def __init__(self, readings, locations, repeat):
+        self.readings = readings
+        self.locations = ["location%d" % i for i in range(locations)]
+        self.repeat = repeat
+
+        self.results = []
+
+        self.collector = TestCollector()
+        self.app = self.collector.start()
+
+        self.flask = self.collector.collector
+
+        # Measure the real work, not the cache or the worker process round trip
+        self.flask.graph_cache = GraphCache(0)
+        self.flask.renderer.workers = 0
+
+    def stop(self):
+        self.collector.stop()
+
+    def record(self, name, **values):
+        values.update({'name': name, 'readings': self.readings, 'locations': len(self.locations)})
+        self.results.append(values)
+
+        print json.dumps(values, sort_keys = True)
+
+    def measure(self, f):
+        """ Returns the list of durations (in ms) of repeated f calls """
+
+        durations = []
+
+        for i in range(self.repeat):
+            start = time.time()
+            f()
+            durations.append((time.time() - start) * 1000)
+
+        return durations
+
+    def summary(self, durations):
+        durations = sorted(durations)
+
+        return {'min_ms': durations[0], 'median_ms': durations[len(durations) / 2], 'max_ms': durations[-1]}
+
+    def seed(self):
+        """
+        Stores the synthetic readings: a daily temperature wave with noise,
+        spread over a year (or one reading per second for large sizes).
+        """
+
+        self.end = int(time.time())
+        self.interval = max(1, 365 * DAY / self.readings)
+        self.start = self.end - self.interval * self.readings
+
+        db_session = self.flask.db_session
+        batch = []
+
+        start = time.time()
+
+        for i in range(self.readings):
+            t = self.start + i * self.interval
+            v = 15 + 10 * math.sin(2 * math.pi * t / DAY) + random.gauss(0, 0.5)
+
+            batch.append({'time': t, 'reading': v, 'location': self.locations[i % len(self.locations)]})
+
+            if len(batch) == 10000:
+                db_session.execute("INSERT INTO readings values (:time, :reading, :location)", batch)
+                batch = []
+
+        if batch:
+            db_session.execute("INSERT INTO readings values (:time, :reading, :location)", batch)
+
+        rollup.backfill(db_session)
+        db_session.commit()
+
+        self.flask.latest.load(db_session)
+
+        if self.flask.window:
+            # The readings were stored bypassing the window
+            self.flask.window.clear()
+            self.flask.window.load(db_session)
+
+        db_session.remove()
+
+        self.record('seed', duration_ms = (time.time() - start) * 1000)
+
+    def post(self, count = 1000):
+        """
+        Single-reading POSTs. Readings posted within the same second share the
+        timestamp, so most of them are answered with 409 after doing the full work.
+        """
+
+        statuses = {}
+        start = time.time()
+
+        for i in range(count):
+            r = self.app.post('/temperature', data = json.dumps({'reading': 20 + i % 2, 'location': self.locations[0]}), content_type = 'application/json')
+            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+        duration = time.time() - start
+
+        self.record('post', count = count, per_second = count / duration, statuses = statuses)
+
+    def post_batch(self, count = 10000):
+        readings = [{'timestamp': self.end + 1 + i, 'reading': 20 + i % 2} for i in range(count)]
+
+        start = time.time()
+        r = self.app.post('/temperature/batch', data = json.dumps(readings), content_type = 'application/json')
+        duration = time.time() - start
+
+        self.record('post_batch', count = count, per_second = count / duration, response = json.loads(r.data))
+
+    def ranges(self):
+        for days in [1, 7, 30, 365]:
+            if days * DAY <= self.end - self.start:
+                yield days, self.end - days * DAY, self.end
+
+    def get(self):
+        for days, start, end in self.ranges():
+            for ext in FORMATS:
+                url = "/temperature?start=%d&end=%d&format=%s" % (start, end, ext)
+
+                durations = self.measure(lambda: self.app.get(url).data)
+                self.record('get', days = days, format = ext, **self.summary(durations))
+
+    def stages(self):
+        for days, start, end in self.ranges():
+            url = "/temperature?start=%d&end=%d" % (start, end)
+
+            with self.flask.test_request_context(url):
+                temperature = Temperature(request)
+
+                durations = self.measure(lambda: temperature.read_data(self.flask.db_session, start, end))
+                self.record('read_data', days = days, **self.summary(durations))
+
+                timestamps, values, groups = temperature.read_data(self.flask.db_session, start, end)
+
+                durations = self.measure(lambda: Graph(timestamps, values).build())
+                self.record('build', days = days, points = len(timestamps), **self.summary(durations))
+
+                graph = Graph(timestamps, values).build()
+
+                for ext in ['png', 'svg', 'pdf']:
+                    durations = self.measure(lambda: graph.render(ext))
+                    self.record('render', days = days, format = ext, **self.summary(durations))
+
+                self.flask.db_session.remove()
+
+    def run(self):
+        self.seed()
+        self.stages()
+        self.get()
+        self.post()
+        self.post_batch()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks the ingest, query and render paths")
+    parser.add_argument('--readings', default = '10000', help = "comma separated numbers of seeded readings (default: 10000)")
+    parser.add_argument('--locations', type = int, default = 3, help = "number of locations (default: 3)")
+    parser.add_argument('--repeat', type = int, default = 5, help = "number of measured runs of every request (default: 5)")
+    parser.add_argument('--output', default = 'benchmark.json', help = "file to write the results to (default: benchmark.json)")
+
+    args = parser.parse_args()
+    results = []
+
+    for readings in [int(r) for r in args.readings.split(',')]:
+        benchmark = Benchmark(readings, args.locations, args.repeat)
+
+        try:
+            benchmark.run()
+        finally:
+            benchmark.stop()
+
+        results.extend(benchmark.results)
+
+    with open(args.output, 'w') as f:
+        json.dump({'timestamp': int(time.time()), 'results': results}, f, indent = 2, sort_keys = True)
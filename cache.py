@@ -0,0 +1,52 @@
+import threading
+
+from collections import OrderedDict
+
+class GraphCache:
+    """
+    Bounded in-memory cache of rendered graphs.
+
+    Least recently used entries are evicted when the total size
+    of the cached data exceeds max_size (in bytes).
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.pop(key, None)
+
+            if data is None:
+                self.misses += 1
+                return None
+
+            # Move the entry to the end; it's the most recently used one now
+            self.entries[key] = data
+            self.hits += 1
+
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_size:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+
+            if old is not None:
+                self.size -= len(old)
+
+            self.entries[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_size:
+                k, d = self.entries.popitem(last = False)
+                self.size -= len(d)
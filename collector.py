@@ -1,9 +1,17 @@
+import atexit
+import os
 import re
+import sys
+import threading
+import time
+import urllib
+import urlparse
 
 from flask import Flask
 from flask import request
 from flask import jsonify
 from flask import abort, redirect, url_for
+from flask import make_response
 
 from werkzeug.exceptions import default_exceptions
 from werkzeug.exceptions import HTTPException
@@ -12,13 +20,29 @@ from werkzeug.exceptions import NotFound
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.pool import StaticPool
-from sqlalchemy import Column, Integer, Float, String, create_engine, desc
+from sqlalchemy import Column, Integer, Float, String, create_engine, desc, event
 
-from graph import Graph
+from cache import GraphCache
+from renderer import Renderer
 from utils import Timer, init_logging
 from temperature import Temperature
 
 from errors import CollectorException
+from ingest import LatestReadings
+from writer import WriteBehind
+from metrics import registry
+from stream import Broadcaster
+from retention import Compactor
+from columnar import ColumnStore
+from window import HotWindow
+from shards import Shards
+from listener import Listener
+from profiling import Profiler
+
+import rollup
+import archive
+import shards
+import profiling
 
 class Collector(Flask):
     def __init__(self):
@@ -40,9 +64,31 @@ class Collector(Flask):
         except:
           pass
 
+        self.graph_cache = GraphCache(self.config['GRAPH_CACHE_SIZE'])
+        self.latest = LatestReadings()
+        self.writer = None
+        self.store = None
+        self.broadcaster = Broadcaster(self.config['STREAM_BACKLOG'])
+        self.compactor = None
+        self.window = None
+        self.shards = None
+        self.listener = None
+
+        # Counts the changes of the stored data (see changed); with the
+        # time of the last one, versions the cached graphs and the ETags
+        self.version = 0
+        self.modified = 0
+        self.version_lock = threading.Lock()
+
+        self.renderer = Renderer(self.config['GRAPH_WORKERS'], self.config['GRAPH_QUEUE'], self.config['GRAPH_TIMEOUT'], self.config['GRAPH_RETRY_AFTER'], self.config['GRAPH_WARM_UP'])
+
         self.define_routes()
         self.register_error_handlers()
 
+        if self.config['PROFILE']:
+            profiler = Profiler(self.config['PROFILE_PATH'], self.config['PROFILE_KEEP'], self.config['PROFILE_RATE'], self.config['PROFILE_SECRET'])
+            profiler.install(self, ['temperature'])
+
         init_logging(self)
 
     def define_routes(self):
@@ -68,16 +114,69 @@ class Collector(Flask):
             elif request.method == 'POST':
                 return temp.process_post(self.db_session)
 
+        """
+        Adds a list of readings to the database in one go.
+        Used by sensors replaying readings buffered while offline.
+        """
+        @self.route("/temperature/batch", methods=['POST'])
+        def batch():
+            return Temperature(request).process_batch(self.db_session)
+
+        """
+        Returns aggregates (min, max, mean, count, percentiles)
+        of the readings per bucket.
+        """
+        @self.route("/temperature/stats", methods=['GET'])
+        def stats():
+            return Temperature(request).stats(self.db_session)
+
         @self.route("/temperature/last", methods=['GET'])
         def last():
             return Temperature(request).last()
 
+        """
+        Pushes every stored reading to the client as Server-Sent Events.
+        """
+        @self.route("/temperature/stream", methods=['GET'])
+        def stream():
+            return Temperature(request).stream()
+
+        """
+        Exposes request stage latencies and counters in the Prometheus text format.
+        """
+        @self.route("/metrics", methods=['GET'])
+        def metrics():
+            registry.set('graph_cache_hits', self.graph_cache.hits)
+            registry.set('graph_cache_misses', self.graph_cache.misses)
+            registry.set('graph_cache_bytes', self.graph_cache.size)
+
+            if self.writer:
+                registry.set('write_behind_queue', self.writer.queue.qsize())
+
+            response = make_response(registry.render())
+            response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+
+            return response
+
         @self.teardown_request
         def shutdown_session(exception=None):
-            self.db_session.remove()
+            self.shards.remove()
 
 
     def rule_the_world(self):
+        # Fork the renderers before the server starts any threads
+        self.renderer.start()
+        atexit.register(self.renderer.stop)
+
+        self.start_threads()
+
+        if self.config['LINE_UDP_PORT'] or self.config['LINE_TCP_PORT']:
+            self.listener = Listener(self, self.config['LINE_HOST'], self.config['LINE_UDP_PORT'], self.config['LINE_TCP_PORT'])
+            self.listener.start()
+
+            # Don't lose the queued readings on shutdown
+            atexit.register(self.listener.stop)
+
         self.run(self.config['HOST'], self.config['PORT'], self.config['DEBUG'])
 
     def register_error_handlers(self):
@@ -103,7 +202,12 @@ class Collector(Flask):
         @self.errorhandler(CollectorException)
         def application_error(ex):
             self.logger.warn("%s: %s [%s]", ex.__class__.__name__, ex.message, ex.description)
-            return prepare_error(ex.message, ex.description, ex.code)
+            response = prepare_error(ex.message, ex.description, ex.code)
+
+            if getattr(ex, 'retry_after', None):
+                response.headers['Retry-After'] = str(ex.retry_after)
+
+            return response
 
         @self.errorhandler(Exception)
         def error(ex):
@@ -113,11 +217,27 @@ class Collector(Flask):
             self.error_handler_spec[None][code] = http_error
 
 
+    def connect(self, path):
+        engine = create_engine("sqlite:///" + path, convert_unicode=True)
+
+        if self.config['WRITE_BEHIND']:
+            # Readers don't block the writer thread (and vice versa) in WAL mode
+            @event.listens_for(engine, 'connect')
+            def set_wal(connection, record):
+                connection.execute("PRAGMA journal_mode=WAL")
+
+        return engine
+
     def init_db(self):
-        engine = create_engine("sqlite:///" + self.config['DATABASE'] , convert_unicode=True)
-        self.db_session = scoped_session(sessionmaker(autocommit=False,
+        engines = [self.connect(shards.path(self.config['DATABASE'], i)) for i in range(self.config['SHARDS'])]
+
+        self.shards = Shards([scoped_session(sessionmaker(autocommit=False,
                                           autoflush=False,
-                                          bind=engine))
+                                          bind=engine)) for engine in engines])
+
+        # The first shard is the database itself
+        self.db_session = self.shards.sessions[0]
+
         Base = declarative_base()
         Base.query = self.db_session.query_property()
 
@@ -136,10 +256,142 @@ class Collector(Flask):
             def __repr__(self):
                 return "[Reading %s %s %s ]" % (self.timestamp, self.value, self.location)
 
-        Base.metadata.create_all(bind=engine)
+        rollup.define_tables(Base.metadata)
+        archive.define_tables(Base.metadata)
+
+        for engine in engines:
+            connection = engine.connect()
+
+            if not engine.has_table('readings'):
+                # Lets the compactor return the freed pages in small steps;
+                # only takes effect before the first table is created
+                connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+            Base.metadata.create_all(bind=connection)
+            connection.close()
+
+            # Serves the per location graphs; created separately so
+            # the databases created before get it too
+            engine.execute("CREATE INDEX IF NOT EXISTS readings_location_timestamp ON readings (location, timestamp)")
+
+        if self.config['STORAGE'] == 'columnar':
+            self.store = ColumnStore(self.config['COLUMNAR_PATH'])
+
+        if self.config['HOT_WINDOW']:
+            self.window = HotWindow(self.config['HOT_WINDOW'], self.config['HOT_WINDOW_SIZE'])
+
+        # With the columnar store the readings aren't in the databases
+        for db_session in [self.db_session] if self.store else self.shards.sessions:
+            self.latest.load(db_session, self.store)
+
+            if self.window:
+                self.window.load(db_session, self.store)
+
+        self.shards.remove()
+
+        if self.config['WRITE_BEHIND']:
+            self.writer = WriteBehind(self, self.config['WRITE_BEHIND_BATCH'], self.config['WRITE_BEHIND_INTERVAL'], self.config['WRITE_BEHIND_QUEUE'], self.config['WRITE_BEHIND_TIMEOUT'])
+
+        if self.config['COMPACTION_INTERVAL']:
+            self.compactor = Compactor(self, self.config['COMPACTION_INTERVAL'], self.config['COMPACTION_BATCH'], self.config['VACUUM_PAGES'])
+
+    def start_threads(self):
+        """
+        Starts the background threads; called after the renderers were
+        forked, so the workers don't inherit them.
+        """
+
+        if self.writer:
+            self.writer.start()
+
+            # Don't lose the queued readings on shutdown
+            atexit.register(self.writer.stop)
+
+        if self.compactor:
+            self.compactor.start()
+
+            atexit.register(self.compactor.stop)
+
+    def stored(self, readings):
+        """
+        Called after new readings were committed to the database.
+        """
+
+        self.latest.update(readings)
+        self.broadcaster.publish(readings)
+
+        if self.window:
+            self.window.update(readings)
+
+        self.changed()
+
+    def changed(self):
+        """ Called after the stored data changed: new readings, compaction, backfill """
+
+        with self.version_lock:
+            self.version += 1
+            self.modified = int(time.time())
+
+    def data_version(self):
+        """
+        Returns the version of the stored data and the unix time of its
+        last change. Writes by other processes are told by the modification
+        times of the database files, which take a stat() rather than a query.
+        """
+
+        stamps = []
+
+        for shard in range(len(self.shards.sessions)):
+            database = shards.path(self.config['DATABASE'], shard)
+
+            for path in [database, database + '-wal']:
+                try:
+                    stamps.append(os.stat(path).st_mtime)
+                except OSError:
+                    pass
+
+        with self.version_lock:
+            return (self.version, tuple(stamps)), int(max([self.modified] + stamps))
+
+    def backfill(self):
+        """
+        Rebuilds the rollup tables from all readings stored in the database.
+        Needs to be run once for databases created before rollups existed.
+        """
+
+        with Timer() as duration:
+            for db_session in self.shards.sessions:
+                try:
+                    rollup.backfill(db_session)
+                    db_session.commit()
+                except:
+                    db_session.rollback()
+                    raise
+
+        self.changed()
+
+        self.logger.info("Backfilling rollup tables took %d ms", duration.miliseconds())
 
 if __name__ == "__main__":
     collector = Collector()
+
+    if sys.argv[1:2] == ['sign'] and len(sys.argv) == 3:
+        # Prints the URL with a signature for profiling the request
+        if not collector.config['PROFILE_SECRET']:
+            sys.exit("PROFILE_SECRET isn't set")
+
+        url = urlparse.urlsplit(sys.argv[2])
+        args = dict(urlparse.parse_qsl(url.query))
+        args['profile'] = '1'
+        args['signature'] = profiling.sign(collector.config['PROFILE_SECRET'], url.path, args)
+
+        print urlparse.urlunsplit(url._replace(query = urllib.urlencode(sorted(args.items()))))
+        sys.exit(0)
+
     collector.init_db()
-    collector.rule_the_world()
+
+    if sys.argv[1:] == ['backfill']:
+        collector.backfill()
+    else:
+        collector.rule_the_world()
  
@@ -0,0 +1,228 @@
+import json
+import os
+import threading
+
+import numpy
+
+# Readings are partitioned by day
+PARTITION = 86400
+
+COLUMNS = [('ts', numpy.int64), ('val', numpy.float64), ('loc', numpy.uint16)]
+
+class ColumnStore:
+    """
+    Append-only columnar storage of readings; an alternative to the
+    readings table.
+
+    Every day is stored in three files holding fixed-width columns:
+    timestamps (int64), values (float64) and location indexes (uint16)
+    into the location dictionary kept in locations.json; index 0 means
+    no location. The files are kept sorted by time, so a range is read
+    by memory-mapping the files and binary-searching the timestamps.
+    Unlike the readings table, several readings can share a timestamp.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.dictionary = os.path.join(path, 'locations.json')
+
+        if os.path.exists(self.dictionary):
+            with open(self.dictionary) as f:
+                self.locations = json.load(f)
+        else:
+            self.locations = [None]
+
+        self.indexes = dict((l, i) for i, l in enumerate(self.locations))
+
+        self.recover()
+
+    def recover(self):
+        """
+        Finishes or discards the partition rewrites interrupted by a crash.
+        The columns are renamed in the order of COLUMNS once all are
+        written, so a left over timestamps file means none was renamed.
+        """
+
+        left = [f for f in os.listdir(self.path) if f.endswith('.tmp') and f != 'locations.json.tmp']
+        unfinished = set(f.split('.')[0] for f in left if f.endswith('.%s.tmp' % COLUMNS[0][0]))
+
+        for f in left:
+            if f.split('.')[0] in unfinished:
+                os.remove(os.path.join(self.path, f))
+            else:
+                os.rename(os.path.join(self.path, f), os.path.join(self.path, f[:-4]))
+
+    def file(self, day, column):
+        return os.path.join(self.path, "%d.%s" % (day, column))
+
+    def days(self):
+        """ Returns the sorted list of stored partitions """
+
+        return sorted(int(f[:-3]) for f in os.listdir(self.path) if f.endswith('.ts'))
+
+    def column(self, day, column):
+        """
+        Memory-maps the column of the partition. Returns an empty array
+        if there is no data; a partially written item at the end is ignored.
+        """
+
+        path = self.file(day, column)
+        dtype = numpy.dtype(dict(COLUMNS)[column])
+
+        if not os.path.exists(path):
+            return numpy.empty(0, dtype)
+
+        count = os.path.getsize(path) / dtype.itemsize
+
+        if not count:
+            return numpy.empty(0, dtype)
+
+        return numpy.memmap(path, dtype = dtype, mode = 'r', shape = (count,))
+
+    def partition(self, day):
+        """
+        Returns the timestamp, value and location index columns of the partition.
+        The columns are trimmed to the same length, so readings appended
+        while we're reading are ignored.
+        """
+
+        columns = [self.column(day, name) for name, dtype in COLUMNS]
+        count = min(len(c) for c in columns)
+
+        return [c[:count] for c in columns]
+
+    def location_index(self, location):
+        if location not in self.indexes:
+            self.locations.append(location)
+            self.indexes[location] = len(self.locations) - 1
+
+            # Replace the dictionary atomically
+            with open(self.dictionary + '.tmp', 'w') as f:
+                json.dump(self.locations, f)
+
+            os.rename(self.dictionary + '.tmp', self.dictionary)
+
+        return self.indexes[location]
+
+    def names(self, indexes):
+        """ Converts an array of location indexes to an array of location names """
+
+        return numpy.array(self.locations, dtype = object)[indexes]
+
+    def append(self, readings):
+        """
+        Stores the readings; expects a list of dictionaries
+        with 'time', 'reading' and 'location' keys.
+        """
+
+        if not readings:
+            return
+
+        with self.lock:
+            ts = numpy.array([r['time'] for r in readings], dtype = numpy.int64)
+            val = numpy.array([r['reading'] for r in readings], dtype = numpy.float64)
+            loc = numpy.array([self.location_index(r['location']) for r in readings], dtype = numpy.uint16)
+
+            order = numpy.argsort(ts, kind = 'mergesort')
+            ts, val, loc = ts[order], val[order], loc[order]
+
+            days = ts // PARTITION
+
+            for day in numpy.unique(days):
+                selected = days == day
+                self.append_partition(int(day), ts[selected], val[selected], loc[selected])
+
+    def append_partition(self, day, ts, val, loc):
+        existing = self.partition(day)
+
+        if len(existing[0]) and existing[0][-1] > ts[0]:
+            # Readings older than the stored ones; the partition is rewritten
+            # sorted into new files, so readers still see the old ones
+            ts, val, loc = [numpy.concatenate((e, n)) for e, n in zip(existing, (ts, val, loc))]
+
+            order = numpy.argsort(ts, kind = 'mergesort')
+
+            # All the columns are written before any is replaced,
+            # so recover() can finish replacing them after a crash
+            for (name, dtype), data in zip(COLUMNS, (ts, val, loc)):
+                with open(self.file(day, name) + '.tmp', 'wb') as f:
+                    f.write(data[order].astype(dtype).tostring())
+
+            for name, dtype in COLUMNS:
+                os.rename(self.file(day, name) + '.tmp', self.file(day, name))
+        else:
+            count = len(existing[0])
+
+            for (name, dtype), data in zip(COLUMNS, (ts, val, loc)):
+                with open(self.file(day, name), 'ab') as f:
+                    # Drop what an append interrupted by a crash left in some
+                    # of the columns, or the columns would stay misaligned
+                    if os.path.getsize(self.file(day, name)) > count * numpy.dtype(dtype).itemsize:
+                        f.truncate(count * numpy.dtype(dtype).itemsize)
+
+                    f.write(data.astype(dtype).tostring())
+
+    def read(self, start, end):
+        """
+        Returns the timestamps, values and location indexes of the readings
+        between start and end, oldest first. Ranges within one day are
+        returned as views of the memory-mapped files, without copying.
+        """
+
+        parts = []
+
+        for day in self.days():
+            if day < start / PARTITION or day > end / PARTITION:
+                continue
+
+            ts, val, loc = self.partition(day)
+
+            first = numpy.searchsorted(ts, start, 'left')
+            last = numpy.searchsorted(ts, end, 'right')
+
+            if last > first:
+                parts.append((ts[first:last], val[first:last], loc[first:last]))
+
+        if not parts:
+            return [numpy.empty(0, dtype) for name, dtype in COLUMNS]
+
+        if len(parts) == 1:
+            return parts[0]
+
+        return [numpy.concatenate(c) for c in zip(*parts)]
+
+    def drop(self, before):
+        """ Deletes the partitions with readings older than before (unix time) """
+
+        with self.lock:
+            for day in self.days():
+                if (day + 1) * PARTITION <= before:
+                    for name, dtype in COLUMNS:
+                        if os.path.exists(self.file(day, name)):
+                            os.remove(self.file(day, name))
+
+    def latest(self):
+        """
+        Returns the newest reading of every location as a list
+        of (timestamp, value, location) tuples.
+        """
+
+        found = {}
+
+        for day in reversed(self.days()):
+            ts, val, loc = self.partition(day)
+
+            for i in numpy.unique(loc):
+                if i not in found:
+                    position = numpy.flatnonzero(loc == i)[-1]
+                    found[i] = (int(ts[position]), float(val[position]), self.locations[i])
+
+            if len(found) == len(self.locations):
+                break
+
+        return found.values()
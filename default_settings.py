@@ -4,7 +4,114 @@ LOG_LEVEL = 'INFO'
 
 DATABASE = 'sqlite:////tmp/test.db'
 
+# Number of databases the readings are split into by location; the first one
+# is DATABASE, the others get the shard number appended to its name
+SHARDS = 1
+
 HOST = "127.0.0.1"
 PORT = 8080
 
 APP_NAME = "collector"
+
+# Number of buckets per accuracy level the graph range is split into;
+# every bucket contributes at most two points (its min and max)
+GRAPH_POINTS = 200
+
+# Maximum size (in bytes) of the rendered graphs kept in memory; 0 disables the cache
+GRAPH_CACHE_SIZE = 32 * 1024 * 1024
+
+# Graph ranges are rounded to this many seconds when looking up the cache
+GRAPH_CACHE_QUANTUM = 60
+
+# Number of rows fetched from the database at once when exporting readings
+EXPORT_CHUNK = 1000
+
+# Ports of the line protocol listeners ("location value [timestamp]" per line);
+# None disables the listener. Without write-behind the listener stores the
+# readings with its own writer, configured by the WRITE_BEHIND_* settings
+LINE_HOST = "127.0.0.1"
+LINE_UDP_PORT = None
+LINE_TCP_PORT = None
+
+# Seconds of the newest readings kept in memory for the graphs; 0 disables
+HOT_WINDOW = 24 * 3600
+
+# Maximum number of readings per location held by the hot window
+HOT_WINDOW_SIZE = 24 * 3600
+
+# Maximum number of buckets returned by /temperature/stats
+STATS_MAX_BUCKETS = 1000
+
+# Number of worker processes rendering the graphs; 0 renders in the request thread
+GRAPH_WORKERS = 2
+
+# Maximum number of graphs waiting for or being rendered; requests over the limit get 503
+GRAPH_QUEUE = 8
+
+# Seconds to wait for a rendered graph before giving up with 503
+GRAPH_TIMEOUT = 30
+
+# Seconds sent in the Retry-After header when the renderers are overloaded
+GRAPH_RETRY_AFTER = 5
+
+# Load matplotlib and draw a graph in the renderers on startup
+# instead of on the first graph request
+GRAPH_WARM_UP = True
+
+# Queue new readings and store them in batches from a background thread
+WRITE_BEHIND = False
+
+# Maximum number of readings stored in one transaction
+WRITE_BEHIND_BATCH = 500
+
+# Seconds to collect readings before storing an incomplete batch
+WRITE_BEHIND_INTERVAL = 1.0
+
+# Maximum number of readings waiting to be stored
+WRITE_BEHIND_QUEUE = 10000
+
+# Seconds to wait for a free place in a full queue before failing with 503
+WRITE_BEHIND_TIMEOUT = 1.0
+
+# Where the raw readings are stored: 'sqlite' (the readings table) or 'columnar'
+STORAGE = 'sqlite'
+
+# Directory of the columnar store
+COLUMNAR_PATH = '/tmp/collector-readings'
+
+# Number of readings kept for clients resuming the event stream
+STREAM_BACKLOG = 1000
+
+# Seconds between keep-alive comments on an idle event stream
+STREAM_HEARTBEAT = 15
+
+# Days to keep the raw readings and every rollup resolution; None keeps them forever
+RETENTION = {'raw': 30, 'minute': 90, 'hour': 2 * 365, 'day': None}
+
+# Seconds between deleting the expired data (see RETENTION and ARCHIVE_AFTER);
+# None disables it. It deletes data, so it has to be enabled explicitly
+COMPACTION_INTERVAL = None
+
+# Maximum number of rows deleted in one transaction
+COMPACTION_BATCH = 5000
+
+# Maximum number of pages returned to the filesystem in one incremental vacuum step
+VACUUM_PAGES = 256
+
+# Days after which the readings are moved into the compressed archive; None disables it
+ARCHIVE_AFTER = 7
+
+# Profile requests of /temperature with cProfile
+PROFILE = False
+
+# Share of the requests profiled at random, between 0 and 1
+PROFILE_RATE = 0.0
+
+# Secret signing ?profile=1 requests (see "python collector.py sign"); None disables them
+PROFILE_SECRET = None
+
+# Directory of the saved profiles
+PROFILE_PATH = '/tmp/collector-profiles'
+
+# Number of newest profiles kept
+PROFILE_KEEP = 100
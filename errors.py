@@ -10,3 +10,8 @@ class DataException(CollectorException):
     def __init__(self, message, description = None, code = 500):
         CollectorException.__init__(self, message, description, code)
 
+class OverloadException(CollectorException):
+    def __init__(self, message, description = None, retry_after = 5):
+        CollectorException.__init__(self, message, description, 503)
+
+        self.retry_after = retry_after
@@ -1,33 +1,185 @@
 import datetime
+import itertools
 import StringIO
-import matplotlib as mpl
-
-from flask import current_app as app
+import threading
+import time
 
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.dates import AutoDateFormatter
-from matplotlib.dates import AutoDateLocator
+from logging import getLogger
 
-from database import db_session
 from utils import Timer
 
-from werkzeug.exceptions import NotFound, BadRequest
+import numpy
+
+logger = getLogger('graph')
 
-import time
-from time import strftime
+# Line colors of overlaid series
+PALETTE = ['purple', 'red', 'blue', 'green', 'orange', 'brown']
 
-from sqlalchemy.sql.expression import *
+# Smoothing kernels by window type and length
+KERNELS = {}
 
-import numpy
+# Matplotlib takes a good part of a second to import;
+# it's loaded on the first graph (see load)
+mpl = None
+Figure = FigureCanvas = AutoDateLocator = AutoDateFormatter = None
+
+# Matplotlib date number of the unix epoch
+EPOCH = None
+
+lock = threading.Lock()
+
+# Configured figures reused by the next graphs of the thread
+templates = threading.local()
+
+def load():
+    """ Imports matplotlib, once """
+
+    global mpl, Figure, FigureCanvas, AutoDateLocator, AutoDateFormatter, EPOCH
+
+    with lock:
+        if mpl is not None:
+            return
+
+        import matplotlib
+        import matplotlib.dates
+
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+        from matplotlib.dates import AutoDateFormatter
+        from matplotlib.dates import AutoDateLocator
+
+        EPOCH = matplotlib.dates.date2num(datetime.datetime(1970, 1, 1))
+        mpl = matplotlib
+
+        logger.debug("Loaded matplotlib %s", mpl.__version__)
+
+def warm_up():
+    """
+    Loads matplotlib and draws a graph, so the first request doesn't
+    wait for the imports, the fonts and the figure template.
+    """
+
+    now = time.time()
+    render([(None, numpy.array([now - 60, now]), numpy.array([0.0, 1.0]))])
+
+def configure(maximize, xlabel, ylabel):
+    """ Builds a figure and its axes, with the ticks, labels and date formatting set up """
+
+    # Everything is configured on the figure itself instead of
+    # the global mpl.rc state, which is shared by all the threads
+    fig = Figure(figsize = (10, 5), dpi = 100)
+    FigureCanvas(fig)
+
+    if maximize:
+        ax = fig.add_axes((0, 0, 1, 1))
+
+        # Put the labels on the inside of the graph
+        # when plotting a maximized graph
+
+
+        yticks = ax.yaxis.get_major_ticks()
+
+#        for t in yticks[-2:]
+#            t.label.set_visible(False)
+
+#        yticks[-1].label.set_visible(False)
+#        yticks[0].label.set_visible(False)
+
+        for tick in yticks:
+            tick.set_pad(-22)
+
+        for tick in ax.xaxis.get_major_ticks():
+            tick.set_pad(-25)
+
+    else:
+        ax = fig.add_axes((0.08, 0.1, 0.9, 0.85))
+
+        if ylabel:
+            ax.set_ylabel('C', fontsize = 14)
+
+        if xlabel:
+            ax.set_xlabel('Date', fontsize = 14)
+
+    ax.tick_params(axis='both', which='major', labelsize=9)
+
+    adl = AutoDateLocator()
+    myformatter = AutoDateFormatter(adl)
+
+    ax.xaxis.set_major_locator(adl)
+    ax.xaxis.set_major_formatter(myformatter)
+
+    ax.grid(True)
+
+    myformatter.scaled = {
+        365.0 : '%Y',           # view interval > 356 days
+        30. : '%b %Y',          # view interval > 30 days but less than 365 days
+        1.0 : '%b %d',          # view interval > 1 day but less than 30 days
+        1./24. : '%H:%M',       # view interval > 1 hour but less than 24 hours
+        1./24./60. : '%M:%S',   # view interval > 1 min but less than 1 hour
+        1./24./60./60. : '%S',  # view interval < 1 min
+    }
+
+    return fig, ax
+
+def template(maximize, xlabel, ylabel):
+    """
+    Returns a configured figure and its axes, without the lines of the
+    previous graph. Setting up the axes costs more than plotting, so every
+    thread (or renderer process) keeps its figures and only clears the data;
+    a graph has to be rendered before the thread builds the next one.
+    """
+
+    load()
+
+    figures = templates.__dict__.setdefault('figures', {})
+    key = (maximize, xlabel, ylabel)
+
+    if key not in figures:
+        figures[key] = configure(maximize, xlabel, ylabel)
+
+    fig, ax = figures[key]
+
+    for line in list(ax.lines):
+        line.remove()
+
+    ax.legend_ = None
+    ax.relim()
+
+    return fig, ax
+
+def utc_offset(t):
+    """ Returns the local time offset from UTC (in seconds) at unix time t """
+
+    if time.localtime(t).tm_isdst:
+        return -time.altzone
+
+    return -time.timezone
+
+def to_dates(timestamps):
+    """
+    Converts an array of unix timestamps to matplotlib date numbers in local time.
+    """
+
+    offset = utc_offset(timestamps[0])
+
+    if offset == utc_offset(timestamps[-1]):
+        offsets = offset
+    else:
+        # The range spans a DST change
+        offsets = numpy.array([utc_offset(t) for t in timestamps])
+
+    return (timestamps + offsets) / 86400.0 + EPOCH
 
 class Graph:
    
-    def __init__(self, readings):
-        self.data = []
+    def __init__(self, timestamps, values, label = None):
+        self.timestamps = numpy.asarray(timestamps, dtype = float)
+        self.values = numpy.asarray(values, dtype = float)
+        self.label = label
 
-        for r in readings:
-            self.data.append([r[0], r[1]])
+        # Other series plotted over the first one, as (label,
+        # timestamps, values)
+        self.overlays = []
 
         # Default color for line is purple
         self.color = 'purple'
@@ -56,7 +208,34 @@ class Graph:
     def set_maximize(self, maximize):
         self.maximize = maximize
 
+    def add_series(self, timestamps, values, label = None):
+        self.overlays.append((label, numpy.asarray(timestamps, dtype = float), numpy.asarray(values, dtype = float)))
+
+    def palette(self):
+        """
+        Returns the line colors of the series, starting with the
+        configured color.
+        """
+        colors = [self.color] + [c for c in PALETTE if c != self.color]
+        return itertools.cycle(colors)
+
+    def kernel(self, window_len, window):
+        """ Returns normalized smoothing window, cached by its type and length """
+
+        key = (window, window_len)
+
+        if key not in KERNELS:
+            if window == 'flat': #moving average
+                w = numpy.ones(window_len, 'd')
+            else:
+                w = getattr(numpy, window)(window_len)
+
+            KERNELS[key] = w / w.sum()
+
+        return KERNELS[key]
+
     def smooth(self, x, window_len=11, window='hanning'):
+        """ Returns the smoothed x; the result has the same length as x """
 
         if len(x) < window_len:
             raise ValueError, "Input vector needs to be bigger than window size."
@@ -71,97 +250,37 @@ class Graph:
 
 
         s=numpy.r_[x[window_len-1:0:-1],x,x[-1:-window_len:-1]]
-        #print(len(s))
-        if window == 'flat': #moving average
-            w=numpy.ones(window_len,'d')
-        else:
-            w=eval('numpy.'+window+'(window_len)')
-
-        y=numpy.convolve(w/w.sum(),s,mode='valid')
-        return y
-
-    def build(self):
-        app.logger.info("Generating new graph...")
-
-        app.logger.debug("Configuring the graph...")
-
-        font = {'size': 14}
-
-        mpl.rc('font', **font)
-        mpl.rcParams['lines.linewidth'] = 2
-        mpl.rcParams['figure.figsize'] = 10, 5
-        mpl.rcParams['figure.dpi'] = 100
-
-        self.fig = Figure(facecolor = self.background_color)
-
-        if self.maximize:
-            ax = self.fig.add_axes((0, 0, 1, 1))
 
-            # Put the labels on the inside of the graph
-            # when plotting a maximized graph
+        y=numpy.convolve(self.kernel(window_len, window),s,mode='valid')
 
+        # Trim the reflected edges
+        trim = (window_len - 1) / 2
+        return y[trim:len(y) - (window_len - 1 - trim)]
 
-            yticks = ax.yaxis.get_major_ticks()
-
-#            for t in yticks[-2:]
-#                t.label.set_visible(False)
-
-#            yticks[-1].label.set_visible(False)
-#            yticks[0].label.set_visible(False)
-
-            for tick in yticks:
-                tick.set_pad(-22)
-
-            for tick in ax.xaxis.get_major_ticks():
-                tick.set_pad(-25)
-
-        else:
-            ax = self.fig.add_axes((0.08, 0.1, 0.9, 0.85))
-
-            if self.ylabel:
-                ax.set_ylabel('C')
-
-            if self.xlabel:
-                ax.set_xlabel('Date')
-
-        ax.tick_params(axis='both', which='major', labelsize=9)
-
-        x=[]
-        y=[]
-
-        for r in self.data:
-            x.append(datetime.datetime.fromtimestamp(r[0]))
-            y.append(r[1])
-
-
-        adl = AutoDateLocator()
-        myformatter = AutoDateFormatter(adl)
+    def build(self):
+        logger.info("Generating new graph...")
 
-        ax.xaxis.set_major_locator(adl)
-        ax.xaxis.set_major_formatter(myformatter)
+        self.fig, ax = template(self.maximize, self.xlabel, self.ylabel)
+        self.fig.set_facecolor(self.background_color)
 
-        ax.grid(True)
+        series = [(self.label, self.timestamps, self.values)] + self.overlays
 
-        myformatter.scaled = {
-            365.0 : '%Y',           # view interval > 356 days
-            30. : '%b %Y',          # view interval > 30 days but less than 365 days
-            1.0 : '%b %d',          # view interval > 1 day but less than 30 days
-            1./24. : '%H:%M',       # view interval > 1 hour but less than 24 hours
-            1./24./60. : '%M:%S',   # view interval > 1 min but less than 1 hour
-            1./24./60./60. : '%S',  # view interval < 1 min
-        }
+        with Timer() as duration:
+            for (label, timestamps, values), color in zip(series, self.palette()):
+                x = to_dates(timestamps)
 
-        c = list(self.smooth(y, 9, 'blackman'))
+                if len(values) >= 9:
+                    c = self.smooth(values, 9, 'blackman')
+                else:
+                    c = values
 
-        remove_count = len(c) - len(y)
-        del c[0:remove_count/2]
-        del c[len(c)-remove_count/2:len(c)]
+                ax.plot(x, values, 'o', antialiased = True, color = color if self.overlays else 'black', alpha = 0.2)
+                ax.plot(x, c, '-', antialiased = True, color = color, alpha = 1, linewidth = self.width, label = label)
 
-        with Timer() as duration:
-            ax.plot(x, y, 'o', antialiased = True, color = 'black', alpha = 0.2)
-            ax.plot(x, c, '-', antialiased = True, color = self.color, alpha = 1)
+        logger.debug("Ploting a graph took %d ms", duration.miliseconds())
 
-        app.logger.debug("Ploting a graph took %d ms", duration.miliseconds())
+        if self.overlays:
+            ax.legend(loc = 'best', fontsize = 9)
 
 #        if self.maximize:
             # Hide first and last label on both axes
@@ -175,18 +294,40 @@ class Graph:
         return self
 
     def render(self, t = 'png'):
-        canvas = FigureCanvas(self.fig)
+        canvas = self.fig.canvas
         output = StringIO.StringIO()
 
         with Timer() as duration:
-            if t == 'svg':
-                canvas.print_svg(output)
-            if t == 'pdf':
-                canvas.print_pdf(output)
+            if t in ['svg', 'pdf']:
+                # The Agg canvas hands other formats over to their own backends
+                canvas.print_figure(output, format = t, dpi = self.fig.dpi)
             else:
                 canvas.print_png(output)
 
-        app.logger.debug("Generating %s took %d ms", t.upper(), duration.miliseconds())
+        logger.debug("Generating %s took %d ms", t.upper(), duration.miliseconds())
 
         return output.getvalue()
- 
+
+def render(series, t = 'png'):
+    """
+    Builds and renders the graph of the series, a list of (label,
+    timestamps, values). Returns the data and the durations of
+    building and rendering (in seconds). Used as the task for the
+    renderer pool workers.
+    """
+
+    label, timestamps, values = series[0]
+    graph = Graph(timestamps, values, label)
+
+    for label, timestamps, values in series[1:]:
+        graph.add_series(timestamps, values, label)
+
+    with Timer() as build:
+        graph.build()
+
+    with Timer() as duration:
+        data = graph.render(t)
+
+    # Workers can't reach the metrics of the server process;
+    # the timings are sent back with the data
+    return data, build.seconds(), duration.seconds()
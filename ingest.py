@@ -0,0 +1,156 @@
+"""
+Storing of new readings, shared by all the ways readings get into the database.
+"""
+
+import math
+import threading
+
+import archive
+import rollup
+
+from utils import reading_to_dict
+
+# only if the difference is bigger than this delta
+# we'll save the value in the database
+DELTA = 0.08
+
+# Latest timestamp of a reading; SQLite stores larger ones, but the rest
+# of the code (reading the columnar store, the backfill) ends time there
+MAX_TIME = 2 ** 31 - 1
+
+def valid(t, value):
+    """ Returns True if the timestamp is in range and the value is finite """
+
+    return 0 <= t <= MAX_TIME and not (math.isnan(value) or math.isinf(value))
+
+def similar(last, value):
+    """
+    Returns True if the value doesn't differ enough
+    from the last stored value to be saved.
+    """
+
+    return last is not None and not abs(last - value) > DELTA
+
+def insert(db_session, readings, notify = None, store = None):
+    """
+    Stores the readings in a single transaction.
+
+    Expects a list of dictionaries with 'time', 'reading' and 'location'
+    keys. Readings with a timestamp which is already taken (in the database,
+    its archive or earlier in the list) are skipped. Returns the list of
+    stored readings.
+
+    If the columnar store is given, the readings are appended to it instead
+    of the readings table; the rollups are kept in the database either way.
+
+    After a successful commit the stored readings are passed to notify.
+    """
+
+    if not readings:
+        return []
+
+    if store:
+        try:
+            rollup.update(db_session, readings)
+            db_session.commit()
+        except:
+            db_session.rollback()
+            raise
+
+        # Only once committed; the store can't skip readings stored already,
+        # so appending before a failed commit would store them twice on retry
+        store.append(readings)
+
+        if notify:
+            notify(readings)
+
+        return readings
+
+    times = [r['time'] for r in readings]
+    result = db_session.execute("SELECT timestamp FROM readings WHERE (timestamp BETWEEN :first AND :last)", {'first': min(times), 'last': max(times)})
+
+    taken = set(r[0] for r in result)
+
+    if min(times) < (archive.horizon(db_session) or 0):
+        # Late readings of the sealed days; their timestamps are in the archive
+        taken.update(archive.read(db_session, min(times), max(times))[0].tolist())
+    stored = []
+
+    for r in readings:
+        if r['time'] not in taken:
+            taken.add(r['time'])
+            stored.append(r)
+
+    try:
+        if stored:
+            db_session.execute("INSERT INTO readings values (:time, :reading, :location)", stored)
+            rollup.update(db_session, stored)
+
+        db_session.commit()
+    except:
+        db_session.rollback()
+        raise
+
+    if notify and stored:
+        notify(stored)
+
+    return stored
+
+class LatestReadings:
+    """
+    Process-wide cache of the newest reading of every location,
+    so checking the last reading doesn't need a database query.
+    """
+
+    def __init__(self):
+        self.readings = {}
+        self.lock = threading.Lock()
+
+    def load(self, db_session, store = None):
+        """ Adds the newest readings of the database (or the store), keeping the newer ones """
+
+        if store:
+            result = [dict(zip(['timestamp', 'value', 'location'], r)) for r in store.latest()]
+        else:
+            # SQLite returns the value and location of the row with MAX(timestamp)
+            result = db_session.execute("SELECT MAX(timestamp) AS timestamp, value, location FROM readings GROUP BY location")
+
+        with self.lock:
+            for r in result:
+                current = self.readings.get(r['location'])
+
+                if current is None or r['timestamp'] >= current['timestamp']:
+                    self.readings[r['location']] = reading_to_dict(r['timestamp'], r['value'], r['location'])
+
+    def get(self, location = None):
+        """ Returns the newest reading for the location as dictionary or None """
+
+        return self.readings.get(location)
+
+    def newest(self):
+        """ Returns the newest reading across all locations or None """
+
+        readings = self.readings.values()
+
+        if not readings:
+            return None
+
+        return max(readings, key = lambda r: r['timestamp'])
+
+    def forget(self, readings):
+        """ Removes the readings which are still the newest of their locations """
+
+        with self.lock:
+            for r in readings:
+                current = self.readings.get(r['location'])
+
+                if current is not None and current['timestamp'] == r['time'] and current['value'] == r['reading']:
+                    del self.readings[r['location']]
+
+    def update(self, readings):
+        with self.lock:
+            for r in readings:
+                current = self.readings.get(r['location'])
+
+                if current is None or r['time'] >= current['timestamp']:
+                    self.readings[r['location']] = reading_to_dict(r['time'], r['reading'], r['location'])
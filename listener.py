@@ -0,0 +1,178 @@
+"""
+Plain text line protocol for sensors too small for HTTP and JSON.
+
+Every line holds one reading: "value", "location value" or
+"location value timestamp", where "-" stands for no location.
+Any number of lines can be sent in a UDP datagram or over a TCP
+connection; readings without timestamp get the time of arrival.
+"""
+
+import socket
+import SocketServer
+import threading
+import time
+
+import ingest
+
+from errors import OverloadException
+from metrics import registry
+from writer import WriteBehind
+
+def parse(line, now):
+    """ Returns the reading of the line as dictionary, or None if it isn't valid """
+
+    parts = line.split()
+
+    try:
+        if len(parts) == 1:
+            location, value, t = None, parts[0], now
+        elif len(parts) == 2:
+            location, value, t = parts[0], parts[1], now
+        elif len(parts) == 3:
+            location, value, t = parts[0], parts[1], int(parts[2])
+        else:
+            return None
+
+        value = float(value)
+
+        if location is not None:
+            location = None if location == '-' else location.decode('utf-8')
+    except ValueError:
+        return None
+
+    if not ingest.valid(t, value):
+        return None
+
+    return {'time': t, 'reading': value, 'location': location}
+
+class LineHandler(SocketServer.BaseRequestHandler):
+    """ Reads the lines of a TCP connection, a buffer at a time """
+
+    def handle(self):
+        pending = ''
+
+        while True:
+            data = self.request.recv(65536)
+
+            if not data:
+                break
+
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+
+            self.server.listener.receive(lines)
+
+        if pending:
+            self.server.listener.receive([pending])
+
+class LineServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Listener:
+    """
+    Accepts readings in the line protocol over UDP and TCP. The readings
+    are checked and deduplicated like the ones posted over HTTP and
+    stored in batches by the write-behind writer (the app's one, or an
+    own one when write-behind is disabled). Readings are counted in
+    line_readings_total once stored; the ones skipped because their
+    second is taken already (readings without timestamp arriving within
+    the same second share it) are counted in line_duplicates_total.
+    """
+
+    def __init__(self, app, host, udp_port = None, tcp_port = None):
+        self.app = app
+        self.host = host
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+
+        self.writer = None
+        self.udp = None
+        self.tcp = None
+
+    def start(self):
+        self.writer = self.app.writer
+
+        if self.writer is None:
+            config = self.app.config
+
+            self.writer = WriteBehind(self.app, config['WRITE_BEHIND_BATCH'], config['WRITE_BEHIND_INTERVAL'], config['WRITE_BEHIND_QUEUE'], config['WRITE_BEHIND_TIMEOUT'])
+            self.writer.start()
+
+        if self.udp_port:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+            # Bursts of datagrams wait in the kernel while a batch is parsed
+            self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            self.udp.bind((self.host, self.udp_port))
+
+            self.thread(self.serve_udp, 'line-udp')
+
+        if self.tcp_port:
+            self.tcp = LineServer((self.host, self.tcp_port), LineHandler)
+            self.tcp.listener = self
+
+            self.thread(self.tcp.serve_forever, 'line-tcp')
+
+        self.app.logger.info("Listening for line protocol readings on %s (UDP port %s, TCP port %s)", self.host, self.udp_port, self.tcp_port)
+
+    def thread(self, target, name):
+        thread = threading.Thread(target = target, name = name)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """ Stops accepting readings and stores the pending ones """
+
+        if self.udp:
+            self.udp.close()
+
+        if self.tcp:
+            self.tcp.shutdown()
+            self.tcp.server_close()
+
+        if self.writer is not self.app.writer:
+            self.writer.stop()
+
+    def serve_udp(self):
+        while True:
+            try:
+                data = self.udp.recv(65536)
+            except socket.error:
+                # Closed by stop()
+                break
+
+            self.receive(data.split('\n'))
+
+    def receive(self, lines):
+        """ Checks, deduplicates and queues the readings of the lines """
+
+        now = int(time.time())
+
+        rejected = skipped = 0
+
+        for line in lines:
+            if not line.strip():
+                continue
+
+            r = parse(line, now)
+
+            if r is None:
+                rejected += 1
+                continue
+
+            last = self.writer.last(r['location'])
+
+            if last and ingest.similar(last['value'], r['reading']):
+                skipped += 1
+                continue
+
+            try:
+                # Waiting for a place in the queue would stall the receiving
+                self.writer.put(r, False, 'line')
+            except OverloadException:
+                # Nobody to tell; the sensor sends a new reading soon anyway
+                registry.inc('line_dropped_total')
+
+        registry.inc('line_rejected_total', rejected)
+        registry.inc('dedupe_skips_total', skipped)
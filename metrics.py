@@ -0,0 +1,101 @@
+"""
+Process-wide latency histograms and counters, exposed
+in the Prometheus text format on /metrics.
+"""
+
+import bisect
+import threading
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Upper bounds of the histogram buckets counting rows
+ROW_BUCKETS = [10, 100, 1000, 10000, 100000, 1000000]
+
+PREFIX = 'collector_'
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            yield "%s_bucket%s %d" % (name, format_labels(labels + (('le', str(bound)),)), cumulative)
+
+        yield "%s_sum%s %s" % (name, format_labels(labels), repr(float(self.sum)))
+        yield "%s_count%s %d" % (name, format_labels(labels), self.count)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join('%s="%s"' % (k, v) for k, v in labels) + "}"
+
+class Registry:
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, buckets = LATENCY_BUCKETS, **labels):
+        """ Adds the value to the histogram with given name and labels """
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+
+            self.histograms[key].observe(value)
+
+    def inc(self, name, value = 1, **labels):
+        """ Increases the counter with given name and labels """
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Sets the gauge with given name and labels """
+
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self):
+        """ Returns all the metrics in the Prometheus text format """
+
+        lines = []
+
+        with self.lock:
+            for kind, metrics in [('histogram', self.histograms), ('counter', self.counters), ('gauge', self.gauges)]:
+                typed = set()
+
+                for (name, labels), metric in sorted(metrics.items()):
+                    if name not in typed:
+                        lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+                        typed.add(name)
+
+                    if kind == 'histogram':
+                        lines.extend(metric.lines(PREFIX + name, labels))
+                    else:
+                        lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), metric))
+
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
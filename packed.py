@@ -0,0 +1,98 @@
+"""
+Compact binary format of the readings export, column by column.
+
+The stream starts with the MAGIC bytes and the format VERSION, followed
+by blocks of readings, newest first. Every block (all little-endian):
+
+    uint32   number of readings (n)
+    int64    timestamp of the first reading
+    uint32   length of the location dictionary
+    bytes    location dictionary, a JSON list of names (null for none)
+    int32[n] timestamp deltas to the previous reading (0 for the first)
+    float64[n] values
+    uint16[n] location numbers, indexes into the dictionary
+"""
+
+import json
+import struct
+import zlib
+
+import numpy
+
+MIME = 'application/x-collector-readings'
+
+MAGIC = 'TMPC'
+VERSION = 1
+
+BLOCK_HEADER = '<IqI'
+
+def header():
+    return MAGIC + struct.pack('<B', VERSION)
+
+def encode_block(rows):
+    """ Encodes a list of (timestamp, value, location) rows as a block """
+
+    timestamps, values, locations = zip(*rows)
+
+    timestamps = numpy.array(timestamps, dtype = numpy.int64)
+    names, indexes = numpy.unique(numpy.array(locations, dtype = object), return_inverse = True)
+
+    dictionary = json.dumps(names.tolist())
+    deltas = numpy.r_[0, numpy.diff(timestamps)]
+
+    return (struct.pack(BLOCK_HEADER, len(rows), timestamps[0], len(dictionary)) + dictionary +
+        deltas.astype('<i4').tostring() +
+        numpy.array(values, dtype = '<f8').tostring() +
+        indexes.astype('<u2').tostring())
+
+def decode(data):
+    """ Returns the timestamps, values and locations (NumPy arrays) of the encoded readings """
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a readings stream")
+
+    offset = len(MAGIC) + 1
+    timestamps, values, locations = [], [], []
+
+    while offset < len(data):
+        n, first, length = struct.unpack_from(BLOCK_HEADER, data, offset)
+        offset += struct.calcsize(BLOCK_HEADER)
+
+        names = numpy.array(json.loads(data[offset:offset + length]), dtype = object)
+        offset += length
+
+        deltas = numpy.frombuffer(data, '<i4', n, offset)
+        timestamps.append(first + numpy.cumsum(deltas, dtype = numpy.int64))
+        offset += 4 * n
+
+        values.append(numpy.frombuffer(data, '<f8', n, offset))
+        offset += 8 * n
+
+        locations.append(names[numpy.frombuffer(data, '<u2', n, offset)])
+        offset += 2 * n
+
+    if not timestamps:
+        return numpy.empty(0, numpy.int64), numpy.empty(0, numpy.float64), numpy.empty(0, object)
+
+    return numpy.concatenate(timestamps), numpy.concatenate(values), numpy.concatenate(locations)
+
+def generate(chunks):
+    """ Yields the encoded stream of the chunks (lists of rows) """
+
+    yield header()
+
+    for rows in chunks:
+        yield encode_block(rows)
+
+def gzipped(parts):
+    """ Compresses the stream of parts with gzip, part by part """
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for part in parts:
+        data = compressor.compress(part)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
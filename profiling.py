@@ -0,0 +1,157 @@
+"""
+Profiling of sampled or explicitly requested requests with cProfile.
+
+A request is profiled when it's picked by the sample rate, or when it
+carries ?profile=1 signed with the secret (see sign). The stats are saved
+to a directory holding the newest profiles only; the file name tells the
+endpoint, the range, the number of rows read and the format, so the
+profiles of slow requests are easy to pick. Streamed responses are
+profiled until the last part is sent.
+"""
+
+import cProfile
+import hashlib
+import hmac
+import os
+import random
+import re
+import time
+import urllib
+
+from flask import g, request
+
+def sign(secret, path, args):
+    """
+    Returns the signature of the request path and its parameters (the
+    request args or a dict), leaving out the signature parameter.
+    """
+
+    items = args.items(multi = True) if hasattr(args, 'getlist') else args.items()
+    query = urllib.urlencode(sorted((k, v) for k, v in items if k != 'signature'))
+
+    return hmac.new(secret, "%s?%s" % (path, query), hashlib.sha256).hexdigest()
+
+def count(rows):
+    """ Adds to the rows read by the profiled request, if it's profiled """
+
+    info = getattr(g, 'profile_info', None)
+
+    if info is not None:
+        info['rows'] += rows
+
+def active():
+    """ Returns True if the current request is profiled """
+
+    return getattr(g, 'profile_info', None) is not None
+
+def slug(value):
+    return re.sub(r'[^A-Za-z0-9]+', '_', str(value)).strip('_') or '-'
+
+class Profiler:
+
+    def __init__(self, path, keep = 100, rate = 0.0, secret = None):
+        self.path = path
+        self.keep = keep
+        self.rate = rate
+        self.secret = secret
+
+    def wanted(self):
+        """ Returns True if the current request should be profiled """
+
+        if self.secret and request.args.get('profile') == '1':
+            expected = sign(self.secret, request.path, request.args)
+            return hmac.compare_digest(expected, str(request.args.get('signature', '')))
+
+        return self.rate > 0 and random.random() < self.rate
+
+    def install(self, app, endpoints):
+        """ Profiles the requests of the endpoints of the app """
+
+        @app.before_request
+        def start_profile():
+            if request.endpoint not in endpoints or not self.wanted():
+                return
+
+            g.profile_info = {
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'start': request.args.get('start', '-'),
+                'end': request.args.get('end', '-'),
+                'rows': 0
+            }
+
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+        @app.after_request
+        def finish_profile(response):
+            profiler = getattr(g, 'profiler', None)
+
+            if profiler is None:
+                return response
+
+            profiler.disable()
+            g.profiler = None
+
+            info = g.profile_info
+            info['format'] = request.args.get('format') or response.mimetype.split('/')[-1]
+
+            if response.is_streamed:
+                response.response = self.streamed(profiler, info, response.response)
+            else:
+                self.dump(profiler, info)
+
+            return response
+
+        @app.teardown_request
+        def stop_profile(exception = None):
+            # after_request is skipped when an exception propagates; the
+            # profiler would stay enabled on the thread for later requests
+            profiler = getattr(g, 'profiler', None)
+
+            if profiler is not None:
+                profiler.disable()
+                g.profiler = None
+
+    def streamed(self, profiler, info, parts):
+        """ Profiles sending the parts of a streamed response, then saves the profile """
+
+        try:
+            iterator = iter(parts)
+
+            while True:
+                profiler.enable()
+
+                try:
+                    part = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    profiler.disable()
+
+                yield part
+        finally:
+            self.dump(profiler, info)
+
+    def dump(self, profiler, info):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        name = "%d-%s-%s-%s-%s-%drows-%s.prof" % (int(time.time() * 1000), slug(info['endpoint']), info['method'].lower(),
+            slug(info['start']), slug(info['end']), info['rows'], slug(info['format']))
+
+        profiler.dump_stats(os.path.join(self.path, name))
+
+        self.rotate()
+
+    def rotate(self):
+        """ Removes the oldest profiles over the limit; the names start with the time """
+
+        profiles = sorted(f for f in os.listdir(self.path) if f.endswith('.prof'))
+
+        for f in profiles[:max(0, len(profiles) - self.keep)]:
+            try:
+                os.remove(os.path.join(self.path, f))
+            except OSError:
+                # Removed by another process already
+                pass
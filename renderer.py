@@ -0,0 +1,110 @@
+import multiprocessing
+import threading
+
+import graph
+import metrics
+
+from errors import OverloadException
+
+def attempt(series, ext):
+    """
+    Renders the graph in a worker process. Errors are returned rather
+    than raised, as the pool calls back only for successful tasks.
+    """
+
+    try:
+        return None, graph.render(series, ext)
+    except Exception as e:
+        return e, None
+
+class Renderer:
+    """
+    Renders graphs in a pool of worker processes, so a slow render
+    doesn't block the request threads (and sensors posting readings).
+
+    At most queue_depth renders can be waiting or running at the same time;
+    requests above the limit fail right away with 503 and Retry-After.
+    With no workers configured the graphs are rendered in the request thread.
+    """
+
+    def __init__(self, workers, queue_depth, timeout, retry_after, warm_up = False):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.warm_up = warm_up
+
+        self.pool = None
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the worker processes. Should be called before the server
+        starts its threads; until then the graphs are rendered in the
+        request thread. With warm_up matplotlib is loaded and a graph
+        drawn in every worker (or right away without workers) before
+        serving requests.
+        """
+
+        with self.lock:
+            if self.workers and self.pool is None:
+                self.pool = multiprocessing.Pool(self.workers, graph.warm_up if self.warm_up else None)
+            elif not self.workers and self.warm_up:
+                graph.warm_up()
+                self.warm_up = False
+
+    def render(self, series, ext, inline = False):
+        """ Renders the graph; inline in the calling thread even with workers """
+
+        data, build, render = self.run(series, ext, inline)
+
+        metrics.registry.observe('graph_build_seconds', build)
+        metrics.registry.observe('graph_render_seconds', render, format = ext)
+
+        return data
+
+    def run(self, series, ext, inline = False):
+        pool = self.pool
+
+        if inline or not self.workers or pool is None:
+            return graph.render(series, ext)
+
+        with self.lock:
+            if self.pending >= self.queue_depth:
+                metrics.registry.inc('graph_rejected_total')
+                raise OverloadException("Server busy", "Too many graphs are being generated; try again later", self.retry_after)
+
+            self.pending += 1
+
+        try:
+            # The render keeps its place in the queue until the worker is
+            # done with it, even when the request stopped waiting for it
+            result = pool.apply_async(attempt, (series, ext), callback = self.done)
+        except:
+            self.done(None)
+            raise
+
+        try:
+            error, data = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            metrics.registry.inc('graph_timeouts_total')
+            raise OverloadException("Server busy", "Generating the graph took too long; try again later", self.retry_after)
+
+        if error:
+            raise error
+
+        return data
+
+    def done(self, result):
+        with self.lock:
+            self.pending -= 1
+
+    def stop(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+                # Terminated renders never call back
+                self.pending = 0
@@ -0,0 +1,217 @@
+"""
+Retention of old readings.
+
+The compactor periodically moves the readings older than ARCHIVE_AFTER
+days into the compressed archive and deletes the readings (raw or archived)
+and rollups older than configured in RETENTION. Raw readings are summarized
+into the rollup tables before they're archived or deleted. All the work is
+done in small transactions, so ingestion is never blocked for long, and the
+freed pages are returned with incremental VACUUM in small steps too.
+"""
+
+import threading
+import time
+
+import archive
+import rollup
+
+DAY = 86400
+
+def expired(retention, name, now):
+    """
+    Returns the unix time before which the data of given resolution
+    ('raw' or a rollup name) are deleted, or None if they're kept forever.
+    Always a whole day, so days are never expired partially.
+    """
+
+    days = retention.get(name)
+
+    if days is None:
+        return None
+
+    cutoff = now - days * DAY
+
+    return cutoff - cutoff % DAY
+
+def finest_width(retention, start, now = None):
+    """
+    Returns the width (in seconds) of the finest resolution
+    which still holds the data starting at start.
+    """
+
+    now = now or int(time.time())
+    cutoff = expired(retention, 'raw', now)
+
+    if cutoff is None or start >= cutoff:
+        return 1
+
+    for name, width in rollup.RESOLUTIONS:
+        cutoff = expired(retention, name, now)
+
+        if cutoff is None or start >= cutoff:
+            return width
+
+    return rollup.RESOLUTIONS[-1][1]
+
+def kept_since(db_session):
+    """
+    Returns the start of the oldest day of raw readings (in the readings
+    table or the archive) if older raw readings were expired, or None if
+    none were. Days are expired whole while their rollups are kept longer,
+    so rollups older than that day tell the raw readings are gone.
+    """
+
+    rolled = []
+
+    for name, width in rollup.RESOLUTIONS:
+        bucket = db_session.execute("SELECT MIN(bucket) FROM %s" % rollup.table(name)).scalar()
+
+        if bucket is not None:
+            rolled.append(bucket * width)
+
+    if not rolled:
+        return None
+
+    raw = [t for t in (db_session.execute("SELECT MIN(timestamp) FROM readings").scalar(), archive.oldest(db_session)) if t is not None]
+
+    if not raw:
+        # All of them expired
+        return 2 ** 31
+
+    day = min(raw) - min(raw) % DAY
+
+    return day if min(rolled) < day else None
+
+class Compactor(threading.Thread):
+
+    def __init__(self, app, interval, batch_size, vacuum_pages):
+        threading.Thread.__init__(self, name = 'compactor')
+        self.daemon = True
+
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.compact()
+            except:
+                self.app.logger.exception("Compacting the database failed")
+            finally:
+                self.app.shards.remove()
+
+    def stop(self):
+        """ Stops the thread, after the compaction in progress if any """
+
+        self.stopping.set()
+        self.join()
+
+    def compact(self, now = None):
+        """ Compacts every shard, one after another """
+
+        now = now or int(time.time())
+
+        for db_session in self.app.shards.sessions:
+            self.compact_shard(db_session, now)
+
+        self.app.changed()
+
+    def compact_shard(self, db_session, now):
+        retention = self.app.config['RETENTION']
+
+        if self.app.config['ARCHIVE_AFTER'] is not None and not self.app.store:
+            self.seal(db_session, now - self.app.config['ARCHIVE_AFTER'] * DAY)
+
+        cutoff = expired(retention, 'raw', now)
+
+        if cutoff is not None:
+            self.expire_raw(db_session, cutoff)
+
+        for name, width in rollup.RESOLUTIONS:
+            cutoff = expired(retention, name, now)
+
+            if cutoff is not None:
+                self.delete(db_session, "DELETE FROM %(table)s WHERE rowid IN (SELECT rowid FROM %(table)s WHERE bucket < :cutoff LIMIT :limit)" % {'table': rollup.table(name)}, cutoff / width)
+
+        self.vacuum(db_session)
+
+    def seal(self, db_session, before):
+        """ Moves the readings of the whole days before given time into the archive """
+
+        oldest = db_session.execute("SELECT MIN(timestamp) FROM readings").scalar()
+
+        if oldest is None:
+            return
+
+        for day in xrange(oldest - oldest % DAY, before - before % DAY, DAY):
+            count = archive.seal(db_session, day)
+
+            if count:
+                self.app.logger.info("Archived %d readings of %s", count, time.strftime("%Y-%m-%d", time.gmtime(day)))
+
+    def expire_raw(self, db_session, cutoff):
+        """ Summarizes and deletes the raw readings older than cutoff, day by day """
+
+        if self.app.store:
+            # Rollups of the columnar store are only kept up to date on insert
+            self.app.store.drop(cutoff)
+            return
+
+        self.delete(db_session, "DELETE FROM archive WHERE rowid IN (SELECT rowid FROM archive WHERE day < :cutoff LIMIT :limit)", cutoff / DAY)
+
+        oldest = db_session.execute("SELECT MIN(timestamp) FROM readings").scalar()
+
+        if oldest is None:
+            return
+
+        for day in xrange(oldest - oldest % DAY, cutoff, DAY):
+            # Readings stored before the rollup tables existed would be lost
+            # without this; archived days were summarized when sealed
+            try:
+                if not archive.archived(db_session, day / DAY):
+                    rollup.backfill(db_session, day, day + DAY - 1)
+
+                db_session.commit()
+            except:
+                db_session.rollback()
+                raise
+
+            self.delete(db_session, "DELETE FROM readings WHERE timestamp IN (SELECT timestamp FROM readings WHERE timestamp < :cutoff LIMIT :limit)", day + DAY)
+
+            self.app.logger.info("Compacted readings of %s", time.strftime("%Y-%m-%d", time.gmtime(day)))
+
+    def delete(self, db_session, query, cutoff):
+        """ Runs the delete query in transactions of at most batch_size rows """
+
+        while True:
+            try:
+                deleted = db_session.execute(query, {'cutoff': cutoff, 'limit': self.batch_size}).rowcount
+                db_session.commit()
+            except:
+                db_session.rollback()
+                raise
+
+            if deleted < self.batch_size:
+                break
+
+            # Let the writers in
+            time.sleep(0.01)
+
+    def vacuum(self, db_session):
+        """ Returns the free pages to the filesystem, vacuum_pages at a time """
+
+        if db_session.execute("PRAGMA auto_vacuum").scalar() != 2:
+            self.app.logger.warn("Incremental vacuum is not enabled; run VACUUM on the database once to enable it")
+            return
+
+        while db_session.execute("PRAGMA freelist_count").scalar() > 0:
+            # Every step of the pragma frees one page; fetching the
+            # result runs it to the end
+            db_session.execute("PRAGMA incremental_vacuum(%d)" % self.vacuum_pages).fetchall()
+            db_session.commit()
+
+            time.sleep(0.01)
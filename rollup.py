@@ -0,0 +1,146 @@
+"""
+Rollup tables keep the lowest, highest and mean reading together with
+the number of readings for every minute, hour and day, so long ranges
+can be graphed without scanning the raw readings table.
+"""
+
+from sqlalchemy import Table, Column, Integer, Float, String, UniqueConstraint
+
+# Name and width (in seconds) of the rollup resolutions, finest first
+RESOLUTIONS = [('minute', 60), ('hour', 3600), ('day', 86400)]
+
+INSERT_QUERY = """
+    INSERT OR IGNORE INTO %(table)s (bucket, location, min, min_timestamp, max, max_timestamp, mean, count)
+        VALUES (:bucket, :location, :reading, :time, :reading, :time, 0, 0)
+"""
+
+# All the expressions are evaluated against the old row values
+UPDATE_QUERY = """
+    UPDATE %(table)s SET
+        min_timestamp = CASE WHEN :reading < min THEN :time ELSE min_timestamp END,
+        min = MIN(min, :reading),
+        max_timestamp = CASE WHEN :reading > max THEN :time ELSE max_timestamp END,
+        max = MAX(max, :reading),
+        mean = (mean * count + :reading) / (count + 1),
+        count = count + 1
+    WHERE bucket = :bucket AND location = :location
+"""
+
+# Only the buckets which still have their raw readings are rebuilt; the
+# rollups of the archived days (which may have got a late reading in the
+# readings table) and of the expired ones can't be computed again
+BACKFILL_QUERY = """
+    INSERT OR REPLACE INTO %(table)s (bucket, location, min, min_timestamp, max, max_timestamp, mean, count)
+        SELECT timestamp / :width AS b, COALESCE(location, '') AS l, MIN(value), NULL, MAX(value), NULL, AVG(value), COUNT(*)
+        FROM readings WHERE (timestamp BETWEEN :start AND :end) AND timestamp / 86400 NOT IN (SELECT day FROM archive) GROUP BY b, l
+"""
+
+BACKFILL_TIMESTAMPS_QUERY = """
+    UPDATE %(table)s SET
+        min_timestamp = (SELECT timestamp FROM readings
+            WHERE (timestamp BETWEEN %(table)s.bucket * :width AND (%(table)s.bucket + 1) * :width - 1)
+            AND COALESCE(location, '') = %(table)s.location ORDER BY value ASC, timestamp LIMIT 1),
+        max_timestamp = (SELECT timestamp FROM readings
+            WHERE (timestamp BETWEEN %(table)s.bucket * :width AND (%(table)s.bucket + 1) * :width - 1)
+            AND COALESCE(location, '') = %(table)s.location ORDER BY value DESC, timestamp LIMIT 1)
+    WHERE bucket BETWEEN :start / :width AND :end / :width AND bucket * :width / 86400 NOT IN (SELECT day FROM archive)
+        AND EXISTS (SELECT 1 FROM readings WHERE timestamp BETWEEN %(table)s.bucket * :width AND (%(table)s.bucket + 1) * :width - 1)
+"""
+
+# Same approach as the raw downsampling query; every bucket contributes
+# its lowest and highest reading
+READ_QUERY = """
+    SELECT min_timestamp AS timestamp, MIN(min) AS value, %(series)s AS series FROM %(table)s
+        WHERE (bucket BETWEEN :start / :width AND :end / :width) AND (min_timestamp BETWEEN :start AND :end)%(where)s
+        GROUP BY %(group)sbucket * :width / :bucket
+    UNION
+    SELECT max_timestamp AS timestamp, MAX(max) AS value, %(series)s AS series FROM %(table)s
+        WHERE (bucket BETWEEN :start / :width AND :end / :width) AND (max_timestamp BETWEEN :start AND :end)%(where)s
+        GROUP BY %(group)sbucket * :width / :bucket
+    ORDER BY timestamp
+"""
+
+# Merges the buckets of the rollup into buckets of :bucket seconds;
+# the sum of the readings is restored from the mean and the count
+STATS_QUERY = """
+    SELECT bucket * :width / :bucket, MIN(min), MAX(max), SUM(mean * count), SUM(count) FROM %(table)s
+        WHERE (bucket BETWEEN :start / :width AND :end / :width)%(where)s GROUP BY 1
+"""
+
+def table(name):
+    return "readings_" + name
+
+def define_tables(metadata):
+    """
+    Registers the rollup tables in the metadata.
+    Readings without location are stored with an empty location
+    so the (bucket, location) pair stays unique.
+    """
+
+    for name, width in RESOLUTIONS:
+        Table(table(name), metadata,
+            Column('bucket', Integer, nullable=False),
+            Column('location', String, nullable=False, default=''),
+            Column('min', Float, nullable=False),
+            Column('min_timestamp', Integer),
+            Column('max', Float, nullable=False),
+            Column('max_timestamp', Integer),
+            Column('mean', Float, nullable=False),
+            Column('count', Integer, nullable=False),
+            UniqueConstraint('bucket', 'location'))
+
+def resolution(bucket):
+    """
+    Returns the coarsest rollup resolution (name, width) which is not
+    wider than the requested bucket, or None if the raw readings
+    need to be used.
+    """
+
+    selected = None
+
+    for name, width in RESOLUTIONS:
+        if width <= bucket:
+            selected = (name, width)
+
+    return selected
+
+def update(db_session, readings):
+    """
+    Adds the readings to all rollup tables. Expects a list of dictionaries
+    with 'time', 'reading' and 'location' keys; doesn't commit.
+    """
+
+    for name, width in RESOLUTIONS:
+        params = []
+
+        for r in readings:
+            params.append({'bucket': r['time'] / width, 'location': r['location'] or '', 'time': r['time'], 'reading': r['reading']})
+
+        db_session.execute(INSERT_QUERY % {'table': table(name)}, params)
+        db_session.execute(UPDATE_QUERY % {'table': table(name)}, params)
+
+def backfill(db_session, start = 0, end = 2 ** 31):
+    """
+    Rebuilds the rollup tables from the raw readings between start and end
+    still in the readings table (see BACKFILL_QUERY). The range is extended
+    to whole days so no bucket is left half-computed. Doesn't commit.
+    """
+
+    start = start - start % 86400
+    end = end - end % 86400 + 86399
+
+    for name, width in RESOLUTIONS:
+        params = {'start': start, 'end': end, 'width': width}
+
+        db_session.execute(BACKFILL_QUERY % {'table': table(name)}, params)
+        db_session.execute(BACKFILL_TIMESTAMPS_QUERY % {'table': table(name)}, params)
+
+def read_query(name, clauses):
+    """
+    Returns the downsampling query of the rollup table; clauses
+    fill in the series number, the location filter and grouping.
+    """
+    return READ_QUERY % dict(clauses, table = table(name))
+
+def stats_query(name, where):
+    return STATS_QUERY % {'table': table(name), 'where': where}
@@ -0,0 +1,34 @@
+"""
+Helpers working on readings stored as NumPy arrays.
+"""
+
+import numpy
+
+def minmax(timestamps, values, bucket, groups = None):
+    """
+    Splits the readings (sorted by time) into buckets of given width
+    (in seconds) and returns the indexes of the lowest and the highest
+    reading of every bucket, in time order. If groups (an array of
+    series numbers) is given, every series is bucketed separately.
+    """
+
+    if bucket <= 1 or len(timestamps) == 0:
+        return numpy.arange(len(timestamps))
+
+    keys = timestamps // bucket
+
+    if groups is None:
+        groups = numpy.zeros(len(timestamps), dtype = int)
+
+    # Readings sorted by series, bucket and by value inside the bucket
+    order = numpy.lexsort((values, keys, groups))
+
+    boundary = (keys[order][1:] != keys[order][:-1]) | (groups[order][1:] != groups[order][:-1])
+
+    first = numpy.flatnonzero(numpy.r_[True, boundary])
+    last = numpy.r_[first[1:] - 1, len(order) - 1]
+
+    selected = numpy.unique(numpy.concatenate((order[first], order[last])))
+
+    # Back in time order (unique sorts the indexes, which are in time order)
+    return selected
@@ -0,0 +1,89 @@
+"""
+Readings split across several SQLite databases by location, so the
+sensors of different locations don't wait for a single writer lock.
+"""
+
+import os
+import threading
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+import ingest
+
+def path(database, shard):
+    """ Returns the file of the shard; the first shard is the database itself """
+
+    if shard == 0:
+        return database
+
+    base, extension = os.path.splitext(database)
+
+    return "%s-%d%s" % (base, shard, extension)
+
+def call(function, db_session):
+    try:
+        return function(db_session)
+    finally:
+        # Sessions are per thread; give the pool thread's connection back
+        db_session.remove()
+
+class Shards:
+    """
+    The sessions of the shards. Every location is stored in one shard,
+    picked by the hash of its name; reads of several locations query
+    all the shards in parallel on a thread pool.
+    """
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def index(self, location):
+        # Unlike hash(), CRC32 is the same in every process and every run
+        return (zlib.crc32((location or '').encode('utf-8')) & 0xffffffff) % len(self.sessions)
+
+    def session(self, location):
+        """ Returns the session of the shard the location is stored in """
+
+        return self.sessions[self.index(location)]
+
+    def map(self, function):
+        """
+        Calls function with the session of every shard, in parallel, and
+        returns the results in the order of the shards. Runs outside of
+        the request context; function must not use the current app.
+        """
+
+        if len(self.sessions) == 1:
+            return [function(self.sessions[0])]
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(len(self.sessions))
+
+        return self.pool.map(lambda db_session: call(function, db_session), self.sessions)
+
+    def insert(self, readings, notify = None, store = None):
+        """
+        Stores the readings (see ingest.insert), each in the shard of its
+        location, in a transaction per shard. Returns the stored readings.
+        """
+
+        batches = {}
+
+        for r in readings:
+            batches.setdefault(self.index(r['location']), []).append(r)
+
+        stored = []
+
+        for shard, batch in sorted(batches.items()):
+            stored.extend(ingest.insert(self.sessions[shard], batch, notify, store))
+
+        return stored
+
+    def remove(self):
+        for db_session in self.sessions:
+            db_session.remove()
@@ -0,0 +1,125 @@
+"""
+Small graphs without axes, labels or smoothing, drawn straight from
+the readings without matplotlib: SVG paths, or a polyline rasterized
+into a NumPy buffer and encoded as PNG.
+"""
+
+import itertools
+import struct
+import zlib
+
+import numpy
+
+# Line colors of the series (RGB), same order as the graph palette
+COLORS = [(128, 0, 128), (255, 0, 0), (0, 0, 255), (0, 128, 0), (255, 165, 0), (165, 42, 42)]
+
+# Accepted width and height (in pixels)
+MIN_SIZE = 4
+MAX_SIZE = 2000
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+def scale(series, width, height):
+    """
+    Maps the series, a list of (label, timestamps, values), onto the
+    pixels of the image. Returns a list of (x, y) arrays; all the series
+    share the scale, the oldest reading is on the left and the highest
+    one at the top. A pixel is left around so the line isn't cut.
+    """
+
+    timestamps = numpy.concatenate([t for label, t, v in series])
+    values = numpy.concatenate([v for label, t, v in series])
+
+    t0, t_span = timestamps.min(), timestamps.max() - timestamps.min()
+    v0, v_span = values.min(), values.max() - values.min()
+
+    points = []
+
+    for label, t, v in series:
+        # Single readings are drawn as a dot, flat ranges in the middle
+        if len(t) == 1:
+            t, v = numpy.repeat(t, 2), numpy.repeat(v, 2)
+
+        if t_span:
+            x = 1 + (t - t0) * (width - 3) / float(t_span)
+        else:
+            x = numpy.linspace(1, width - 2, len(t))
+
+        if v_span:
+            y = height - 2 - (v - v0) * (height - 3) / float(v_span)
+        else:
+            y = numpy.empty(len(v))
+            y.fill((height - 1) / 2.0)
+
+        points.append((x, y))
+
+    return points
+
+def svg(series, width, height):
+    paths = []
+
+    for (x, y), color in zip(scale(series, width, height), itertools.cycle(COLORS)):
+        d = "M" + " L".join("%.1f,%.1f" % point for point in zip(x, y))
+        paths.append('<path d="%s" fill="none" stroke="#%02x%02x%02x" stroke-width="1.5" stroke-linejoin="round" stroke-linecap="round"/>' % ((d,) + color))
+
+    return '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d">%s</svg>' % (width, height, width, height, "".join(paths))
+
+def rasterize(x, y):
+    """
+    Returns the pixels (columns and rows) of the polyline through the
+    points. Every segment is sampled once per pixel along its longer side.
+    """
+
+    dx, dy = numpy.diff(x), numpy.diff(y)
+    steps = numpy.ceil(numpy.maximum(abs(dx), abs(dy))).astype(int) + 1
+
+    segment = numpy.repeat(numpy.arange(len(dx)), steps)
+
+    # Position of every sample inside its segment, from 0 to 1
+    offset = numpy.arange(steps.sum()) - numpy.repeat(numpy.cumsum(steps) - steps, steps)
+    fraction = offset / numpy.repeat(numpy.maximum(steps - 1, 1), steps).astype(float)
+
+    columns = numpy.rint(x[segment] + dx[segment] * fraction).astype(int)
+    rows = numpy.rint(y[segment] + dy[segment] * fraction).astype(int)
+
+    return columns, rows
+
+def png(series, width, height):
+    # Transparent background, so the sparkline fits any page
+    image = numpy.zeros((height, width, 4), dtype = numpy.uint8)
+
+    for (x, y), color in zip(scale(series, width, height), itertools.cycle(COLORS)):
+        columns, rows = rasterize(x, y)
+
+        # Two pixels thick line
+        image[rows, columns] = color + (255,)
+        image[numpy.minimum(rows + 1, height - 1), columns] = color + (255,)
+
+    return encode_png(image)
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+def encode_png(image):
+    """ Encodes the RGBA image (a height x width x 4 array of bytes) as PNG """
+
+    height, width = image.shape[:2]
+
+    # Every row starts with its filter type; 0 means no filtering
+    rows = numpy.zeros((height, width * 4 + 1), dtype = numpy.uint8)
+    rows[:, 1:] = image.reshape(height, -1)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+
+    return PNG_SIGNATURE + png_chunk('IHDR', header) + png_chunk('IDAT', zlib.compress(rows.tostring(), 6)) + png_chunk('IEND', '')
+
+def render(series, width, height, t = 'png'):
+    """
+    Renders the sparkline of the series, a list of (label, timestamps,
+    values), in given size (in pixels) and format (png or svg).
+    """
+
+    if t == 'svg':
+        return svg(series, width, height)
+
+    return png(series, width, height)
@@ -0,0 +1,166 @@
+"""
+Aggregates of the readings per time bucket: min, max, mean, count and
+approximate percentiles. Every source (raw readings, rollups, archive
+blocks, columnar store) contributes partial aggregates which are merged
+by bucket, so nothing but the aggregates is held in memory.
+"""
+
+import numpy
+
+import rollup
+
+# Percentiles are read from a histogram of the values rounded to
+# 1 / RESOLUTION degree; the histogram size depends on the spread
+# of the values, not on the number of readings
+RESOLUTION = 10
+
+STATS_QUERY = """
+    SELECT timestamp / :bucket, MIN(value), MAX(value), SUM(value), COUNT(*) FROM readings
+        WHERE (timestamp BETWEEN :start AND :end)%(where)s GROUP BY 1
+"""
+
+HISTOGRAM_QUERY = """
+    SELECT timestamp / :bucket, CAST(ROUND(value * :resolution) AS INTEGER), COUNT(*) FROM readings
+        WHERE (timestamp BETWEEN :start AND :end)%(where)s GROUP BY 1, 2
+"""
+
+def resolution(start, end, bucket, finest = 1):
+    """
+    Returns the coarsest rollup (name and width) holding exactly the
+    readings of every bucket between start and end, or None. The buckets
+    and both ends of the range have to fall on the rollup boundaries.
+    """
+
+    for name, width in reversed(rollup.RESOLUTIONS):
+        if width >= finest and bucket % width == 0 and start % width == 0 and (end + 1) % width == 0:
+            return name, width
+
+    return None
+
+def percentiles(histogram, ranks):
+    """
+    Returns the percentiles (by rank, 0 to 100) of the values
+    counted in the histogram, a dict of rounded value: count.
+    """
+
+    values = sorted(histogram)
+    counts = numpy.cumsum([histogram[v] for v in values])
+
+    result = {}
+
+    for rank in ranks:
+        i = min(numpy.searchsorted(counts, rank / 100.0 * counts[-1]), len(values) - 1)
+        result["%g" % rank] = values[i] / float(RESOLUTION)
+
+    return result
+
+class Stats:
+
+    def __init__(self, bucket, ranks = ()):
+        self.bucket = bucket
+        self.ranks = ranks
+
+        # Bucket number: [min, max, sum, count]
+        self.aggregates = {}
+
+        # Bucket number: {rounded value: count}
+        self.histograms = {}
+
+    def add(self, rows):
+        """ Merges the (bucket number, min, max, sum, count) rows """
+
+        for key, low, high, total, count in rows:
+            if key not in self.aggregates:
+                self.aggregates[key] = [low, high, total, count]
+                continue
+
+            aggregate = self.aggregates[key]
+
+            aggregate[0] = min(aggregate[0], low)
+            aggregate[1] = max(aggregate[1], high)
+            aggregate[2] += total
+            aggregate[3] += count
+
+    def add_histogram(self, rows):
+        """ Merges the (bucket number, rounded value, count) rows """
+
+        for key, value, count in rows:
+            histogram = self.histograms.setdefault(key, {})
+            histogram[value] = histogram.get(value, 0) + count
+
+    def merge(self, other):
+        """ Merges the aggregates of other buckets of the same width """
+
+        self.add([key] + aggregate for key, aggregate in other.aggregates.items())
+        self.add_histogram((key, value, count) for key, histogram in other.histograms.items() for value, count in histogram.items())
+
+    def add_readings(self, timestamps, values):
+        """ Merges the readings (NumPy arrays sorted by time) """
+
+        if not len(timestamps):
+            return
+
+        keys = timestamps // self.bucket
+
+        first = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+        last = numpy.r_[first[1:], len(keys)]
+
+        self.add(zip(keys[first].tolist(),
+            numpy.minimum.reduceat(values, first).tolist(),
+            numpy.maximum.reduceat(values, first).tolist(),
+            numpy.add.reduceat(values, first).tolist(),
+            (last - first).tolist()))
+
+        if not self.ranks:
+            return
+
+        # Half away from zero, like ROUND() of SQLite
+        scaled = values * RESOLUTION
+        rounded = (numpy.sign(scaled) * numpy.floor(numpy.abs(scaled) + 0.5)).astype(numpy.int64)
+
+        for key, i, j in zip(keys[first].tolist(), first, last):
+            counted, counts = numpy.unique(rounded[i:j], return_counts = True)
+            self.add_histogram((key, v, c) for v, c in zip(counted.tolist(), counts.tolist()))
+
+    def result(self):
+        """ Returns the aggregates of the buckets, oldest first """
+
+        result = []
+
+        for key in sorted(self.aggregates):
+            low, high, total, count = self.aggregates[key]
+
+            item = {
+                'start': key * self.bucket,
+                'end': (key + 1) * self.bucket - 1,
+                'min': low,
+                'max': high,
+                'mean': float(total) / count,
+                'count': count
+            }
+
+            if self.ranks:
+                item['percentiles'] = percentiles(self.histograms[key], self.ranks)
+
+            result.append(item)
+
+        return result
+
+def read(db_session, stats, start, end, location = None):
+    """ Adds the aggregates of the raw readings between start and end """
+
+    where = " AND location = :location" if location else ""
+    params = {'start': start, 'end': end, 'bucket': stats.bucket, 'location': location, 'resolution': RESOLUTION}
+
+    stats.add(db_session.execute(STATS_QUERY % {'where': where}, params))
+
+    if stats.ranks:
+        stats.add_histogram(db_session.execute(HISTOGRAM_QUERY % {'where': where}, params))
+
+def read_rollup(db_session, stats, start, end, name, width, location = None):
+    """ Adds the aggregates of the rollup between start and end """
+
+    where = " AND location = :location" if location else ""
+    params = {'start': start, 'end': end, 'bucket': stats.bucket, 'width': width, 'location': location}
+
+    stats.add(db_session.execute(rollup.stats_query(name, where), params))
@@ -0,0 +1,86 @@
+import collections
+import itertools
+import json
+import threading
+
+from utils import reading_to_dict
+
+class Broadcaster:
+    """
+    Fans out stored readings to Server-Sent Events subscribers.
+
+    Readings are kept in a bounded backlog of events with increasing ids.
+    Publishing appends to the backlog and wakes the waiting subscribers,
+    so it costs the same no matter how many clients are connected; every
+    subscriber picks the events it hasn't seen yet from the shared backlog.
+    The backlog also lets reconnecting clients resume with Last-Event-ID.
+    """
+
+    def __init__(self, size):
+        self.backlog = collections.deque(maxlen = size)
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def publish(self, readings):
+        with self.condition:
+            for r in readings:
+                self.last_id += 1
+                self.backlog.append((self.last_id, reading_to_dict(r['time'], r['reading'], r['location'])))
+
+            self.condition.notify_all()
+
+    def since(self, event_id):
+        """
+        Returns the (id, reading) events newer than event_id. If some of
+        them already fell out of the backlog, starts with the oldest one kept.
+        Needs to be called with the condition held.
+        """
+
+        if not self.backlog:
+            return []
+
+        skip = max(0, event_id - self.backlog[0][0] + 1)
+
+        return list(itertools.islice(self.backlog, skip, None))
+
+    def wait(self, event_id, timeout):
+        """ Waits up to timeout seconds for events newer than event_id """
+
+        with self.condition:
+            if self.last_id <= event_id:
+                self.condition.wait(timeout)
+
+            return self.since(event_id)
+
+    def events(self, last_event_id = None, location = None, heartbeat = 15):
+        """
+        Generates the event stream. Starts after last_event_id if given,
+        otherwise with the next published reading. Only readings from
+        the location are sent if it's given. A comment is sent every
+        heartbeat seconds without events to keep the connection open.
+        """
+
+        # Ids start over when the server restarts
+        if last_event_id is None or last_event_id > self.last_id:
+            event_id = self.last_id
+        else:
+            event_id = last_event_id
+
+        # Tell the client how long to wait before reconnecting
+        yield "retry: 3000\n\n"
+
+        while True:
+            events = self.wait(event_id, heartbeat)
+
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+
+            chunk = []
+
+            for event_id, reading in events:
+                if location is None or reading['location'] == location:
+                    chunk.append("id: %d\nevent: reading\ndata: %s\n\n" % (event_id, json.dumps(reading)))
+
+            if chunk:
+                yield "".join(chunk)
@@ -1,15 +1,104 @@
+import calendar
+import collections
+import csv
 import datetime as dt
+import hashlib
+import heapq
+import itertools
+import json
+import StringIO
 import time
 
+import numpy
+
 from flask import current_app as app
 from flask import make_response
 from flask import jsonify
+from flask import Response, stream_with_context
+
+from sqlalchemy import text
 
 from utils import Timer, reading_to_dict
-from graph import Graph
+
+import rollup
+import ingest
+import series
+import retention
+import archive
+import sparkline
+import stats
+import packed
+import profiling
+
+from metrics import registry, ROW_BUCKETS
 
 from errors import *
 
+# SQLite returns the row holding the MIN() / MAX() value for the bare
+# columns, so every bucket contributes its lowest and highest reading
+DOWNSAMPLE_QUERY = """
+    SELECT timestamp, MIN(value) AS value, %(series)s AS series FROM readings
+        WHERE (timestamp BETWEEN :start AND :end)%(where)s GROUP BY %(group)stimestamp / :bucket
+    UNION
+    SELECT timestamp, MAX(value) AS value, %(series)s AS series FROM readings
+        WHERE (timestamp BETWEEN :start AND :end)%(where)s GROUP BY %(group)stimestamp / :bucket
+    ORDER BY timestamp
+"""
+
+# Periods of the ?compare= overlays (in seconds) with
+# the labels of the current and the previous series
+COMPARE = {
+    'day': (86400, 'today', 'yesterday'),
+    'week': (7 * 86400, 'this week', 'last week'),
+    'month': (30 * 86400, 'this month', 'last month'),
+    'year': (365 * 86400, 'this year', 'last year')
+}
+
+def series_clauses(locations):
+    """
+    Returns the clauses of the downsampling queries (series number,
+    location filter and grouping) and their parameters for reading
+    the series of the locations. Without locations all the readings
+    are one series.
+    """
+
+    if not locations:
+        return {'series': '0', 'where': '', 'group': ''}, {}
+
+    names = [':location%d' % i for i in range(len(locations))]
+
+    clauses = {
+        'series': 'CASE location ' + ' '.join('WHEN %s THEN %d' % (n, i) for i, n in enumerate(names)) + ' END',
+        'where': ' AND location IN (%s)' % ', '.join(names),
+        'group': 'location, '
+    }
+
+    return clauses, dict(('location%d' % i, l) for i, l in enumerate(locations))
+
+def series_numbers(keys, wanted):
+    """
+    Returns the series numbers of the readings with the location keys
+    (names or columnar store indexes): the position of the key in the
+    wanted list, -1 for the keys not wanted. Without a wanted list
+    all the readings are series 0.
+    """
+
+    if not wanted:
+        return numpy.zeros(len(keys), dtype = int)
+
+    numbers = numpy.empty(len(keys), dtype = int)
+    numbers.fill(-1)
+
+    for i, key in enumerate(wanted):
+        numbers[keys == key] = i
+
+    return numbers
+
+def label(location, period):
+    """ Returns the legend label of a series """
+
+    return ", ".join(p for p in (location, period) if p) or None
+
 class Temperature:
 
     def __init__(self, request):
@@ -23,11 +112,15 @@ class Temperature:
         # Showing them slowes down generating the graph
         self.data_points = False
 
-        # List of supported mime types
-        self.mime = {   'image/png': 'png',
-                    'image/svg+xml': 'svg',
-                 'application/json': 'json',
-                  'application/pdf': 'pdf'}
+        # List of supported mime types, preferred first
+        # when the client accepts several equally
+        self.mime = collections.OrderedDict([
+                      ('image/png', 'png'),
+                  ('image/svg+xml', 'svg'),
+               ('application/json', 'json'),
+                ('application/pdf', 'pdf'),
+                       ('text/csv', 'csv'),
+                    (packed.MIME, 'bin')])
 
     def set_accuracy(self, accuracy):
         if accuracy <= 0 or accuracy > 5:
@@ -61,8 +154,60 @@ class Temperature:
 
         return start, end
 
+    def validate_series(self):
+        """
+        Returns the locations to plot as separate series (the 'location'
+        parameter may be repeated) and the period to compare the range
+        with (see COMPARE), or None.
+        """
+
+        locations = [l for l in self.request.args.getlist("location") if l]
+        compare = self.request.args.get("compare")
+
+        if compare and compare not in COMPARE:
+            raise DataException("Invalid data", "Unsupported comparison; use one of: " + ", ".join(sorted(COMPARE)), 400)
+
+        return locations, compare
+
+    def validate_style(self, ext):
+        """
+        Returns the size (width and height in pixels) of the requested
+        sparkline (?style=sparkline&w=200&h=40), or None for a full graph.
+        """
+
+        style = self.request.args.get("style")
+
+        if not style:
+            return None
+
+        if style != 'sparkline':
+            raise DataException("Invalid data", "Unsupported style; use 'sparkline'", 400)
+
+        if ext not in ['png', 'svg']:
+            raise DataException("Invalid data", "Sparklines are available only as PNG or SVG", 400)
+
+        try:
+            size = int(self.request.args.get("w", 200)), int(self.request.args.get("h", 40))
+        except ValueError:
+            raise DataException("Invalid data", "Parameters 'w' and 'h' accept only integer numbers", 400)
+
+        if not all(sparkline.MIN_SIZE <= n <= sparkline.MAX_SIZE for n in size):
+            raise DataException("Invalid data", "Sparkline size is out of range; use values between %d and %d" % (sparkline.MIN_SIZE, sparkline.MAX_SIZE), 400)
+
+        return size
+
     def negotiate_mime(self):
-        """ Returns the ngotiated content type and extension """
+        """
+        Returns the ngotiated content type and extension.
+        The 'format' parameter (extension) takes precedence over the Accept header.
+        """
+
+        if self.request.args.get("format"):
+            for selected_mime, extension in self.mime.items():
+                if extension == self.request.args.get("format"):
+                    return selected_mime, extension
+
+            raise DataException("Invalid data", "Unsupported format; use one of: " + ", ".join(sorted(self.mime.values())), 400)
 
         selected_mime = self.request.accept_mimetypes.best_match(self.mime.keys())
         extension = self.mime[selected_mime]
@@ -73,87 +218,455 @@ class Temperature:
 
     def accuracy_factor(self, start, end):
         """
-        # > month 101 - 200 pow 40 40 - 200
-        # > week 11 -  100  pow 20 20 -  80
-        # > day  7 - 10     pow 2   2 -  10
-        #  2 min  1 - 6     pow 1   1 -   5
+        Returns the width (in seconds) of the buckets used to downsample
+        the readings for the graph. The requested range is split into
+        GRAPH_POINTS * accuracy buckets, so higher accuracy means narrower
+        buckets and more points on the graph.
         """
 
-        graph_range = end - start
+        buckets = app.config['GRAPH_POINTS'] * self.accuracy
+        factor = max(1, (end - start) / buckets)
 
-        minute = 60
-        hour = 60 * minute
-        day = 24 * hour
-        week = 7 * day
-        month = 30 * week
+        app.logger.debug("Accuracy: %d", self.accuracy)
+        app.logger.debug("Bucket width: %d s", factor)
 
-        factor = 40
+        return factor
 
-        if graph_range < day:
-            factor = 1
+    def finest_width(self, start):
+        """
+        Returns the width of the finest resolution holding the data since
+        start (see retention.finest_width); 1 as long as the raw readings
+        since start weren't actually expired by the compactor.
+        """
 
-        if graph_range < week:
-            factor = 2
+        finest = retention.finest_width(app.config['RETENTION'], start)
 
-        if graph_range < month:
-            factor = 20
- 
-        app.logger.debug("Factor: %d", factor)
-        app.logger.debug("Accuracy: %d", self.accuracy)
-        app.logger.debug("Result: %d", factor * (6 - self.accuracy))
+        if finest > 1 and not app.store:
+            kept = [k for k in app.shards.map(retention.kept_since) if k is not None]
 
-        return factor * (6 - self.accuracy)
+            if not kept or start >= max(kept):
+                return 1
 
-    def read_data(self, start, end):
-        readings = []
+        return finest
 
-        with Timer() as duration:
-#            result = db_session.execute("SELECT * FROM readings WHERE (date between :start and :end) AND (rowid - (SELECT rowid FROM readings WHERE (date > :start) ORDER BY date DESC LIMIT 1)) % :accuracy = 0 ORDER BY date DESC", {'start': start, 'end': end, 'accuracy': self.accuracy_factor(start, end)})
-            result = db_session.execute("SELECT * FROM readings WHERE (timestamp between :start and :end) ORDER BY timestamp DESC", {'start': start, 'end': end, 'accuracy': self.accuracy_factor(start, end)})
-        
-        for r in result:
-            readings.append([r['timestamp'], r['value'], r['location']])
+    def read_data(self, db_session, start, end, locations = None, bucket = None):
+        """
+        Reads the readings between start and end for the graph (see
+        read_range); fails if there are none.
+        """
+
+        timestamps, values, groups = self.read_range(db_session, start, end, locations, bucket)
+
+        if not len(timestamps):
+            raise DataException("No data", "Requested data range does not have any data; try different range", 400)
+
+        return timestamps, values, groups
+
+    def read_range(self, db_session, start, end, locations = None, bucket = None):
+        """
+        Reads the readings between start and end for the graph. Returns
+        three NumPy arrays, oldest first: timestamps, values and series
+        numbers. With a list of locations only their readings are read and
+        the series number is the position of the reading's location in the
+        list; otherwise all the readings are series 0.
+
+        The range is split into buckets (see accuracy_factor, unless the
+        bucket width is given) and only the lowest and the highest reading
+        of every bucket of every series is returned, so the peaks stay
+        visible while the number of rows doesn't depend on the size of the
+        range. Buckets wider than a minute are served from the coarsest
+        rollup table that still fits into a bucket, as are ranges older
+        than the raw readings retention. Ranges held by the hot window are
+        sliced from memory; with the columnar store the range is sliced
+        from the store instead.
+        """
+
+        # Old raw readings may be gone already; use the rollups then
+        finest = self.finest_width(start)
+
+        bucket = max(bucket or self.accuracy_factor(start, end), finest)
+        params = {'start': start, 'end': end, 'bucket': bucket}
+
+        if app.window and app.window.covers(start, locations):
+            source = 'memory'
+        elif app.store and finest == 1:
+            source = 'columnar'
+        else:
+            source = None
+
+        if source:
+            with Timer('db_read_seconds', source = source) as duration:
+                if source == 'memory':
+                    timestamps, values, groups = app.window.read(start, end, locations)
+                else:
+                    timestamps, values, indexes = app.store.read(start, end)
+                    groups = series_numbers(indexes, locations and [app.store.indexes.get(l, -1) for l in locations])
+
+                selected = series.minmax(timestamps, values, bucket, groups)
+                selected = selected[groups[selected] >= 0]
+
+                timestamps, values, groups = timestamps[selected], values[selected], groups[selected]
+
+            registry.observe('rows_read', len(timestamps), ROW_BUCKETS)
+            profiling.count(len(timestamps))
+
+            app.logger.info("Reading %d records from %s took %d ms", len(timestamps), source, duration.miliseconds())
+
+            return timestamps, values, groups
+
+        clauses, location_params = series_clauses(locations)
+        params.update(location_params)
+
+        if rollup.resolution(bucket):
+            name, params['width'] = rollup.resolution(bucket)
+            query = rollup.read_query(name, clauses)
+
+            app.logger.debug("Using '%s' rollup table", name)
+        else:
+            query = DOWNSAMPLE_QUERY % clauses
+
+        archived = not rollup.resolution(bucket)
+
+        def read(db_session):
+            result = db_session.execute(query, params)
+            data = numpy.fromiter(itertools.chain.from_iterable(result), dtype = float).reshape(-1, 3)
+
+            timestamps, values, groups = data[:, 0], data[:, 1], data[:, 2].astype(int)
+
+            if archived and start < (archive.horizon(db_session) or 0):
+                archived_timestamps, archived_values, archived_locations = archive.read(db_session, start, end)
+                archived_groups = series_numbers(archived_locations, locations)
+
+                selected = series.minmax(archived_timestamps, archived_values, bucket, archived_groups)
+                selected = selected[archived_groups[selected] >= 0]
+
+                timestamps = numpy.concatenate((archived_timestamps[selected], timestamps))
+                values = numpy.concatenate((archived_values[selected], values))
+                groups = numpy.concatenate((archived_groups[selected], groups))
+
+            return timestamps, values, groups
+
+        with Timer('db_read_seconds', source = 'sqlite') as duration:
+            # Every shard is queried in parallel, the rows merged by time
+            parts = app.shards.map(read)
+
+            timestamps, values, groups = [numpy.concatenate(c) for c in zip(*parts)]
+
+            order = numpy.argsort(timestamps, kind = 'mergesort')
+            timestamps, values, groups = timestamps[order], values[order], groups[order]
+
+            if len(parts) > 1:
+                # The shards holding readings of the same series add their own lowest and highest ones
+                selected = series.minmax(timestamps, values, bucket, groups)
+                timestamps, values, groups = timestamps[selected], values[selected], groups[selected]
+
+        registry.observe('rows_read', len(timestamps), ROW_BUCKETS)
+        profiling.count(len(timestamps))
+
+        app.logger.info("Reading %d records from database took %d ms", len(timestamps), duration.miliseconds())
+
+        return timestamps, values, groups
+
+    def export(self, db_session, start, end, ext):
+        """
+        Streams all the readings between start and end, newest first,
+        as JSON, CSV or the binary format (see packed). Rows are fetched
+        from the database cursor (or the columnar store) EXPORT_CHUNK at
+        a time, so the memory use doesn't depend on the size of the range.
+        """
+
+        chunk = app.config['EXPORT_CHUNK']
+
+        if app.store:
+            chunks = self.store_chunks(start, end, chunk)
+        elif len(app.shards.sessions) == 1:
+            chunks = self.shard_chunks(db_session, start, end, chunk)
+        else:
+            chunks = self.merged_chunks([self.shard_chunks(s, start, end, chunk) for s in app.shards.sessions], chunk)
+
+        first = next(chunks, None)
+
+        if not first:
+            raise DataException("No data", "Requested data range does not have any data; try different range", 400)
+
+        def counted(chunks):
+            count = 0
+
+            for rows in chunks:
+                count += len(rows)
+                profiling.count(len(rows))
+
+                yield rows
+
+            registry.observe('rows_read', count, ROW_BUCKETS)
+
+        chunks = counted(itertools.chain([first], chunks))
+
+        def generate_json():
+            # Add the current timestamp with reading from last one read
+            yield '{"readings": [' + json.dumps([int(time.mktime(time.localtime())), first[0][1], None])
+
+            for rows in chunks:
+                yield "".join("," + json.dumps([r[0], r[1], r[2]]) for r in rows)
+
+            yield ']}'
+
+        def generate_csv():
+            output = StringIO.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(['timestamp', 'value', 'location'])
+
+            for rows in chunks:
+                # The Python 2 csv module writes bytes only
+                writer.writerows([[c.encode('utf-8') if isinstance(c, unicode) else c for c in row] for row in rows])
+                yield output.getvalue()
+
+                output.truncate(0)
+
+        if ext == 'csv':
+            response = Response(stream_with_context(generate_csv()), mimetype = 'text/csv')
+            response.headers['Content-Disposition'] = 'attachment; filename="temperature.csv"'
+        elif ext == 'bin':
+            parts = packed.generate(chunks)
+
+            # Compressing a single chunk isn't worth it
+            compress = len(first) == chunk and 'gzip' in self.request.accept_encodings
+
+            if compress:
+                parts = packed.gzipped(parts)
+
+            response = Response(stream_with_context(parts), mimetype = packed.MIME)
+            response.headers['Vary'] = 'Accept-Encoding'
+
+            if compress:
+                response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(stream_with_context(generate_json()), mimetype = 'application/json')
+
+        return response
+
+    def shard_chunks(self, db_session, start, end, chunk):
+        """ Yields lists of (timestamp, value, location) rows of a database and its archive, newest first """
+
+        if start < (archive.horizon(db_session) or 0):
+            return itertools.chain(self.query_chunks(db_session, start, end, chunk), self.archive_chunks(db_session, start, end, chunk))
+
+        return self.query_chunks(db_session, start, end, chunk)
+
+    def merged_chunks(self, sources, chunk):
+        """
+        Merges the rows of several sources (each yielding lists of rows
+        newest first) into lists of rows newest first. Only a chunk of
+        every source is held in memory.
+        """
+
+        # heapq.merge takes the smallest item first, hence the negative
+        # timestamps; the source number breaks the ties of equal ones
+        def keyed(i, source):
+            for rows in source:
+                for r in rows:
+                    yield -r[0], i, r
+
+        streams = [keyed(i, source) for i, source in enumerate(sources)]
+        rows = []
+
+        for key, i, r in heapq.merge(*streams):
+            rows.append(r)
+
+            if len(rows) == chunk:
+                yield rows
+                rows = []
+
+        if rows:
+            yield rows
+
+    def query_chunks(self, db_session, start, end, chunk):
+        """ Yields lists of (timestamp, value, location) rows from the database, newest first """
+
+        query = text("SELECT timestamp, value, location FROM readings WHERE (timestamp BETWEEN :start AND :end) ORDER BY timestamp DESC")
+        result = db_session.execute(query.execution_options(stream_results = True), {'start': start, 'end': end})
+
+        rows = result.fetchmany(chunk)
+
+        while rows:
+            yield rows
+            rows = result.fetchmany(chunk)
+
+    def store_chunks(self, start, end, chunk):
+        """ Yields lists of (timestamp, value, location) rows from the columnar store, newest first """
+
+        timestamps, values, locations = app.store.read(start, end)
+
+        for last in xrange(len(timestamps), 0, -chunk):
+            first = max(0, last - chunk)
+
+            yield zip(timestamps[first:last][::-1].tolist(), values[first:last][::-1].tolist(), app.store.names(locations[first:last][::-1]))
+
+    def archive_chunks(self, db_session, start, end, chunk):
+        """
+        Yields lists of (timestamp, value, location) rows from the archive,
+        newest first. Decodes one day at a time to keep the memory use flat.
+        """
+
+        end = min(end, archive.horizon(db_session) - 1)
+
+        for day in xrange(end / archive.DAY, start / archive.DAY - 1, -1):
+            day_start = day * archive.DAY
+            timestamps, values, locations = archive.read(db_session, max(start, day_start), min(end, day_start + archive.DAY - 1))
+
+            for last in xrange(len(timestamps), 0, -chunk):
+                first = max(0, last - chunk)
+
+                yield zip(timestamps[first:last][::-1].tolist(), values[first:last][::-1].tolist(), locations[first:last][::-1])
+
+    def cache_key(self, start, end, ext, locations = (), compare = None, size = None):
+        """
+        Returns the key of the rendered graph in the graph cache.
+        The version of the stored data is part of the key, so any
+        change (late readings too) invalidates the cached graphs.
+        """
+
+        quantum = app.config['GRAPH_CACHE_QUANTUM']
+        version, modified = app.data_version()
+
+        return (start / quantum, end / quantum, self.accuracy, ext, tuple(locations), compare, size, version)
+
+    def validators(self, key):
+        """
+        Returns the ETag and the Last-Modified time (unix timestamp) of the
+        response identified by the key (normalized request parameters).
+        Both are derived from the version of the stored data, so no data
+        needs to be read.
+        """
+
+        version, modified = app.data_version()
+
+        return hashlib.sha1(repr(key) + repr(version)).hexdigest(), modified
+
+    def not_modified(self, etag, modified):
+        """
+        Returns True if the client already has the current version
+        of the response, as told by If-None-Match or If-Modified-Since.
+        """
+
+        if self.request.if_none_match:
+            return self.request.if_none_match.contains_weak(etag)
+
+        if self.request.if_modified_since:
+            return calendar.timegm(self.request.if_modified_since.utctimetuple()) >= modified
+
+        return False
+
+    def conditional(self, response, etag, modified, weak = False):
+        """
+        Adds the validators to the response. The ETag of a response which
+        may be sent gzipped or not is weak: the bytes differ by encoding.
+        """
+
+        response.set_etag(etag, weak)
+        response.last_modified = dt.datetime.utcfromtimestamp(modified)
+
+        return response
+
+    def graph(self, db_session, start, end, ext, locations = (), compare = None, size = None):
+        """
+        Reads the data and renders the graph in requested format.
+        Every location is plotted as a separate series; when comparing,
+        the same range a period earlier is read too, shifted and plotted
+        over the current one. With a size (width and height in
+        pixels) a sparkline is drawn instead, with a reading per pixel.
+        """
 
-        if not readings:
+        if size:
+            bucket = max(1, (end - start) / size[0])
+        else:
+            bucket = self.accuracy_factor(start, end)
+
+        if compare:
+            period, current, previous = COMPARE[compare]
+        else:
+            period, current, previous = 0, None, None
+
+        timestamps, values, groups = self.read_range(db_session, start, end, locations, bucket)
+
+        if period:
+            # Just the same range a period earlier, plotted shifted over the current one
+            previous_timestamps, previous_values, previous_groups = self.read_range(db_session, start - period, end - period, locations, bucket)
+        else:
+            previous_timestamps = previous_values = previous_groups = numpy.empty(0)
+
+        if not len(timestamps) and not len(previous_timestamps):
             raise DataException("No data", "Requested data range does not have any data; try different range", 400)
 
-        app.logger.info("Reading %d records from database took %d ms", len(readings), duration.miliseconds())
+        now = int(time.mktime(time.localtime()))
+
+        plotted = []
 
-        return readings
+        for i, location in enumerate(locations or [None]):
+            t, v = timestamps[groups == i], values[groups == i]
+
+            if len(t):
+                # Add the current timestamp with reading from last one read to generate appropriate graphics
+                plotted.append((label(location, current), numpy.append(t, now), numpy.append(v, v[-1])))
+
+            t, v = previous_timestamps[previous_groups == i], previous_values[previous_groups == i]
+
+            if len(t):
+                plotted.append((label(location, previous), t + period, v))
+
+        if size:
+            # Fast enough to be drawn in the request thread
+            with Timer('sparkline_render_seconds', format = ext) as duration:
+                data = sparkline.render(plotted, size[0], size[1], ext)
+
+            app.logger.info("Sparkline was generated in %d ms", duration.miliseconds())
+
+            return data
+
+        with Timer() as duration:
+            # A profile of a render in a worker would only show the waiting
+            data = app.renderer.render(plotted, ext, profiling.active())
+
+        app.logger.info("Graph was generated in %d ms", duration.miliseconds())
+
+        return data
 
     def process_get(self, db_session):
         start, end = self.validate_time_range()
-        readings = self.read_data(start, end)
         selected_mime, ext = self.negotiate_mime()
 
-        # Add the current timestamp with reading from last one read to generate appropriate graphics
-        readings.insert(0, [int(time.mktime(time.localtime())), readings[0][1], None])
+        locations, compare = self.validate_series()
+        size = self.validate_style(ext)
 
-        if ext is not 'json':
-            graph = Graph(readings)
-#            graph.set_maximize(True)
+        key = self.cache_key(start, end, ext, locations, compare, size)
+        etag, modified = self.validators(key)
 
-            with Timer() as duration:
-                data = graph.build().render(ext)
+        if self.not_modified(etag, modified):
+            app.logger.debug("Client has the current %s response", ext.upper())
+            return self.conditional(make_response("", 304), etag, modified, ext == 'bin')
 
-            app.logger.info("Graph was generated in %d ms", duration.miliseconds())
+        if ext in ['json', 'csv', 'bin']:
+            return self.conditional(self.export(db_session, start, end, ext), etag, modified, ext == 'bin')
 
-            response = make_response(data)
+        data = app.graph_cache.get(key)
+
+        if data is None:
+            data = self.graph(db_session, start, end, ext, locations, compare, size)
+            app.graph_cache.put(key, data)
         else:
-            response = make_response(jsonify(readings = readings))
+            app.logger.debug("Serving %s graph from cache", ext.upper())
 
+        response = make_response(data)
 
         if ext == 'svg':
             response.headers['Content-Type'] = 'image/svg+xml'
-        elif ext == 'json':
-            response.headers['Content-Type'] = 'application/json'
         elif ext == 'pdf':
             response.headers['Content-Disposition'] = 'attachment; filename="temperature.pdf"'
             response.headers['Content-Type'] = 'application/pdf'
         else:
             response.headers['Content-Type'] = 'image/png'
 
-        return response
+        return self.conditional(response, etag, modified)
 
     def process_post(self, db_session):
         app.logger.debug("Processing new reading...")
@@ -176,37 +689,228 @@ class Temperature:
             l = j['location']
         except:
             l = None
-        # only if the difference is bigger than this delta
-        # we'll save the value in the database
-        delta = 0.08
 
-        result = db_session.execute("SELECT * FROM readings ORDER BY timestamp DESC LIMIT 1").first()
+        if not (l is None or isinstance(l, basestring)):
+            raise DataException("Invalid data", "Parameter 'location' accepts only strings", 400)
 
-        if result:
-            difference = abs(result['value'] - v)
-            if not difference > delta:
-                """
-                The value we want to save doesn't differ much from last reading.
-                Ommit the value and return last reading
-                """
+        if app.writer:
+            last = app.writer.last(l)
+        else:
+            last = app.latest.get(l)
 
-                app.logger.debug("Trying to save too similar reading (difference: " + str(difference) + "), skipping")
+        if last and ingest.similar(last['value'], v):
+            """
+            The value we want to save doesn't differ much from last reading.
+            Ommit the value and return last reading
+            """
 
-                return jsonify(reading_to_dict(result['timestamp'], result['value'], result['location']))
-        
-        try:
-            db_session.execute("INSERT INTO readings values (:time, :reading, :location)", {'time': t, 'reading': v, 'location': l})
-            db_session.commit()
-        except:
-            db_session.rollback()
-            raise
+            app.logger.debug("Trying to save too similar reading (difference: " + str(abs(last['value'] - v)) + "), skipping")
+            registry.inc('dedupe_skips_total')
+
+            return jsonify(last)
+
+        with Timer('post_insert_seconds'):
+            if app.writer:
+                app.writer.put({'time': t, 'reading': v, 'location': l})
+            elif not app.shards.insert([{'time': t, 'reading': v, 'location': l}], app.stored, app.store):
+                raise DataException("Duplicate reading", "There is already a reading stored for this second", 409)
 
         return jsonify(reading_to_dict(t, v, l))
 
+    def process_batch(self, db_session):
+        """
+        Stores a list of readings, each with 'timestamp', 'reading'
+        and optional 'location', in a single transaction.
+
+        Readings which don't differ enough from the previous one
+        or which have an already taken timestamp are skipped,
+        invalid readings are rejected.
+        """
+
+        j = self.request.json
+
+        if isinstance(j, dict):
+            j = j.get('readings')
+
+        if not isinstance(j, list):
+            raise DataException("Invalid data", "Expected a list of readings or an object with 'readings' list", 400)
+
+        app.logger.debug("Processing batch of %d readings...", len(j))
+
+        readings = []
+
+        for item in j:
+            try:
+                r = {'time': int(item['timestamp']), 'reading': float(item['reading']), 'location': item.get('location')}
+            except (KeyError, TypeError, ValueError, AttributeError):
+                continue
+
+            if not ingest.valid(r['time'], r['reading']):
+                continue
+
+            if r['location'] is None or isinstance(r['location'], basestring):
+                readings.append(r)
+
+        rejected = len(j) - len(readings)
+        readings.sort(key = lambda r: r['time'])
+
+        kept = []
+        last = {}
+
+        for r in readings:
+            l = r['location']
+
+            if l not in last:
+                last[l] = self.previous_value(db_session, r['time'], l)
+
+            if not ingest.similar(last[l], r['reading']):
+                kept.append(r)
+                last[l] = r['reading']
+
+        registry.inc('dedupe_skips_total', len(readings) - len(kept))
+
+        with Timer('batch_insert_seconds') as duration:
+            stored = app.shards.insert(kept, app.stored, app.store)
+
+        app.logger.info("Storing batch of %d readings took %d ms", len(stored), duration.miliseconds())
+
+        return jsonify(accepted = len(stored), skipped = len(readings) - len(stored), rejected = rejected)
+
+    def previous_value(self, db_session, t, l):
+        """
+        Returns the value of the reading for location l
+        stored right before t, or None.
+        """
+
+        last = app.latest.get(l)
+
+        # Readings usually arrive in order; the cached one is the right one then
+        if last is None or last['timestamp'] < t:
+            return last and last['value']
+
+        return app.shards.session(l).execute("SELECT value FROM readings WHERE timestamp < :time AND location IS :location ORDER BY timestamp DESC LIMIT 1", {'time': t, 'location': l}).scalar()
+
+    def validate_stats(self, start, end):
+        """
+        Returns the bucket width (in seconds, a day by default), the
+        location and the percentile ranks requested for the statistics.
+        """
+
+        try:
+            bucket = int(self.request.args.get("bucket", 86400))
+            ranks = [float(r) for r in self.request.args.get("percentiles", "").split(",") if r]
+        except ValueError:
+            raise DataException("Invalid data", "Parameter 'bucket' accepts only integer numbers and 'percentiles' a comma separated list of numbers", 400)
+
+        if bucket <= 0:
+            raise DataException("Invalid data", "Bucket width has to be a positive number of seconds", 400)
+
+        if end / bucket - start / bucket >= app.config['STATS_MAX_BUCKETS']:
+            raise DataException("Invalid data", "Too many buckets; use a wider bucket or a shorter range", 400)
+
+        if not all(0 <= r <= 100 for r in ranks):
+            raise DataException("Invalid data", "Percentiles have to be between 0 and 100", 400)
+
+        return bucket, self.request.args.get("location") or None, ranks
+
+    def stats(self, db_session):
+        """
+        Returns min, max, mean, count and optionally approximate percentiles
+        of the readings of every bucket between start and end. Aggregates
+        are computed by the database (or NumPy for the archived days and the
+        columnar store), from the rollups when the buckets allow it.
+        """
+
+        start, end = self.validate_time_range()
+        bucket, location, ranks = self.validate_stats(start, end)
+
+        result = stats.Stats(bucket, ranks)
+
+        finest = self.finest_width(start)
+
+        # Rollups don't keep the values needed for the percentiles
+        found = not ranks and stats.resolution(start, end, bucket, finest)
+
+        if not found and finest > 1:
+            raise DataException("Invalid data", "Raw readings of the range have expired; use a bucket and range aligned to %d seconds, without percentiles" % finest, 400)
+
+        def read(db_session):
+            partial = stats.Stats(bucket, ranks)
+
+            if found:
+                stats.read_rollup(db_session, partial, start, end, found[0], found[1], location)
+                return partial
+
+            stats.read(db_session, partial, start, end, location)
+
+            # One day at a time to keep the memory use flat
+            for day_start in xrange(start - start % archive.DAY, min(end, (archive.horizon(db_session) or 0) - 1) + 1, archive.DAY):
+                timestamps, values, locations = archive.read(db_session, max(start, day_start), min(end, day_start + archive.DAY - 1))
+
+                if location:
+                    selected = locations == location
+                    timestamps, values = timestamps[selected], values[selected]
+
+                partial.add_readings(timestamps, values)
+
+            return partial
+
+        with Timer('stats_seconds') as duration:
+            if app.store and not found:
+                for day_start in xrange(start - start % 86400, end + 1, 86400):
+                    timestamps, values, indexes = app.store.read(max(start, day_start), min(end, day_start + 86399))
+
+                    if location:
+                        selected = indexes == app.store.indexes.get(location, -1)
+                        timestamps, values = timestamps[selected], values[selected]
+
+                    result.add_readings(timestamps, values)
+            else:
+                # Every shard is aggregated in parallel; the aggregates merge
+                for partial in app.shards.map(read):
+                    result.merge(partial)
+
+        if found:
+            app.logger.debug("Using '%s' rollup table", found[0])
+
+        app.logger.info("Computing statistics of %d buckets took %d ms", len(result.aggregates), duration.miliseconds())
+
+        return jsonify(bucket = bucket, location = location, stats = result.result())
+
     def last(self):
-        result = db_session.execute("SELECT * FROM readings ORDER BY timestamp DESC LIMIT 1").first()
+        result = app.latest.newest()
+        etag, modified = self.validators('last')
+
+        if self.not_modified(etag, modified):
+          return self.conditional(make_response("", 304), etag, modified)
 
         if result:
-          return make_response("<h1 style=\"font-size: 80px;\">Last reading: " + str(result['value']) + u"\u00B0C</h1><h2 style=\"font-size: 40px\">Updated at " + time.ctime(result['timestamp']) + "</h2>")
+          response = make_response("<h1 style=\"font-size: 80px;\">Last reading: " + str(result['value']) + u"\u00B0C</h1><h2 style=\"font-size: 40px\">Updated at " + time.ctime(result['timestamp']) + "</h2>")
         else:
-          return make_response("No last reading")
+          response = make_response("No last reading")
+
+        return self.conditional(response, etag, modified)
+
+    def stream(self):
+        """
+        Returns the Server-Sent Events stream of new readings, optionally
+        only for the 'location'. Reconnecting clients resume after
+        the event in the Last-Event-ID header.
+        """
+
+        last_event_id = self.request.headers.get('Last-Event-ID')
+
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            raise DataException("Invalid data", "Header 'Last-Event-ID' accepts only integers", 400)
+
+        events = app.broadcaster.events(last_event_id, self.request.args.get("location"), app.config['STREAM_HEARTBEAT'])
+
+        response = Response(events, mimetype = 'text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+
+        # Don't let proxies buffer the events
+        response.headers['X-Accel-Buffering'] = 'no'
+
+        return response
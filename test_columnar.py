@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+import pytest
+
+from columnar import ColumnStore, PARTITION
+
+class TestColumnStore():
+
+  def setup_method(self, method):
+    self.path = tempfile.mkdtemp()
+    self.store = ColumnStore(self.path)
+
+  def teardown_method(self, method):
+    shutil.rmtree(self.path)
+
+  def append(self, *readings):
+    self.store.append([{'time': t, 'reading': v, 'location': l} for t, v, l in readings])
+
+  def read(self, start = 0, end = 2 ** 31):
+    ts, val, loc = self.store.read(start, end)
+    return ts.tolist(), val.tolist(), self.store.names(loc).tolist()
+
+  def test_append(self):
+    self.append((1000, 12.5, None), (1060, 13, 'balcony'))
+    self.append((1120, 14, 'kitchen'), (1120, -2, 'balcony'))
+
+    assert self.read() == ([1000, 1060, 1120, 1120], [12.5, 13, 14, -2], [None, 'balcony', 'kitchen', 'balcony'])
+    assert self.read(1060, 1060) == ([1060], [13], ['balcony'])
+
+  def test_reopen(self):
+    self.append((1000, 12.5, 'balcony'))
+
+    store = ColumnStore(self.path)
+    ts, val, loc = store.read(0, 2 ** 31)
+
+    assert store.names(loc).tolist() == ['balcony']
+
+  def test_out_of_order(self):
+    self.append((1000, 1, None), (1200, 3, None))
+    self.append((1100, 2, None), (1300, 4, None))
+
+    assert self.read() == ([1000, 1100, 1200, 1300], [1, 2, 3, 4], [None] * 4)
+    assert not [f for f in os.listdir(self.path) if f.endswith('.tmp')]
+
+  def test_across_partitions(self):
+    self.append((PARTITION - 60, 1, None), (PARTITION + 60, 2, None), (3 * PARTITION, 3, None))
+
+    assert self.store.days() == [0, 1, 3]
+    assert self.read() == ([PARTITION - 60, PARTITION + 60, 3 * PARTITION], [1, 2, 3], [None] * 3)
+    assert self.read(PARTITION - 60, PARTITION + 60)[0] == [PARTITION - 60, PARTITION + 60]
+    assert self.read(2 * PARTITION, 2 * PARTITION + 60)[0] == []
+
+  def test_interrupted_append(self):
+    self.append((1000, 1, None))
+
+    # A crash after writing the timestamps of the next append only
+    with open(self.store.file(0, 'ts'), 'ab') as f:
+      f.write(numpy.array([1100], dtype = numpy.int64).tostring())
+
+    assert self.read() == ([1000], [1], [None])
+
+    self.append((1200, 2, None))
+
+    assert self.read() == ([1000, 1200], [1, 2], [None, None])
+
+  def test_recover_unfinished_rewrite(self):
+    self.append((1000, 1, None))
+
+    # A crash before any of the rewritten columns was renamed
+    for name in ['ts', 'val', 'loc']:
+      shutil.copy(self.store.file(0, name), self.store.file(0, name) + '.tmp')
+
+    with open(self.store.file(0, 'ts') + '.tmp', 'ab') as f:
+      f.write(numpy.array([900], dtype = numpy.int64).tostring())
+
+    self.store = ColumnStore(self.path)
+
+    assert self.read() == ([1000], [1], [None])
+    assert not [f for f in os.listdir(self.path) if f.endswith('.tmp')]
+
+  def test_recover_finished_rewrite(self):
+    self.append((1000, 1, None))
+
+    # A crash after the timestamps were renamed, but not the other columns
+    ts, val, loc = [numpy.array(c, dtype = d) for c, d in (([900, 1000], numpy.int64), ([0, 1], numpy.float64), ([0, 0], numpy.uint16))]
+
+    with open(self.store.file(0, 'ts'), 'wb') as f:
+      f.write(ts.tostring())
+
+    for name, data in [('val', val), ('loc', loc)]:
+      with open(self.store.file(0, name) + '.tmp', 'wb') as f:
+        f.write(data.tostring())
+
+    self.store = ColumnStore(self.path)
+
+    assert self.read() == ([900, 1000], [0, 1], [None, None])
+    assert not [f for f in os.listdir(self.path) if f.endswith('.tmp')]
@@ -0,0 +1,85 @@
+import json
+import time
+
+import pytest
+
+from flask import request
+
+import rollup
+
+from retention import Compactor, DAY
+from temperature import Temperature
+from test_utils import TestCollector
+
+class TestRetention():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.app = self.collector.start()
+    self.flask = self.collector.collector
+
+    self.flask.config['RETENTION'] = {'raw': 30, 'minute': 90, 'hour': 2 * 365, 'day': None}
+    self.flask.config['ARCHIVE_AFTER'] = 7
+
+    self.now = int(time.time())
+    today = self.now - self.now % DAY
+
+    # Minute rollups kept, hour rollups only, archived, raw
+    self.days = dict((name, today - days * DAY) for name, days in [('minute', 40), ('hour', 100), ('archived', 10), ('raw', 1)])
+
+    readings = []
+
+    # Differing from day to day, so none is skipped as too similar
+    for i, day in enumerate(sorted(self.days.values())):
+      readings += [
+        {"timestamp": day + 3600, "reading": -2 - i},
+        {"timestamp": day + 3630, "reading": 5 + i, "location": "balcony"},
+        {"timestamp": day + 7200, "reading": 8 + i}
+      ]
+
+    self.app.post('/temperature/batch', data = json.dumps(readings), content_type = 'application/json')
+
+    # Two rows per transaction, so the deletes take several
+    Compactor(self.flask, 1, 2, 256).compact(self.now)
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def count(self, query, **params):
+    return self.flask.db_session.execute(query, params).scalar()
+
+  def test_readings_expired(self):
+    assert self.count("SELECT COUNT(*) FROM readings WHERE timestamp < :day", day = self.days['archived']) == 0
+    assert self.count("SELECT COUNT(*) FROM readings WHERE timestamp >= :day", day = self.days['raw']) == 3
+
+    assert self.count("SELECT COUNT(*) FROM archive") == 2
+    assert self.count("SELECT MIN(day) FROM archive") == self.days['archived'] / DAY
+
+  def test_rollups_kept(self):
+    minute = rollup.table('minute')
+    hour = rollup.table('hour')
+
+    assert self.count("SELECT COUNT(*) FROM %s WHERE bucket < :bucket" % minute, bucket = self.days['minute'] / 60) == 0
+    assert self.count("SELECT COUNT(*) FROM %s WHERE bucket / 1440 = :day" % minute, day = self.days['minute'] / DAY) == 3
+    assert self.count("SELECT COUNT(*) FROM %s WHERE bucket / 24 = :day" % hour, day = self.days['hour'] / DAY) == 3
+    assert self.count("SELECT COUNT(*) FROM %s WHERE bucket = :day" % rollup.table('day'), day = self.days['hour'] / DAY) == 2
+
+  def read(self, name):
+    with self.flask.test_request_context('/temperature'):
+      return Temperature(request).read_range(self.flask.db_session, self.days[name], self.days[name] + DAY - 1, None, 1)
+
+  def test_graph_from_rollups(self):
+    timestamps, values, groups = self.read('minute')
+
+    assert timestamps.tolist() == [self.days['minute'] + 3600, self.days['minute'] + 3630, self.days['minute'] + 7200]
+    assert values.tolist() == [-3, 6, 9]
+
+    timestamps, values, groups = self.read('hour')
+
+    assert timestamps.tolist() == [self.days['hour'] + 3600, self.days['hour'] + 3630, self.days['hour'] + 7200]
+    assert values.tolist() == [-2, 5, 8]
+
+    r = self.app.get('/temperature?start=%d&end=%d&format=png' % (self.days['hour'], self.days['hour'] + DAY - 1))
+
+    assert r.status_code == 200
+    assert r.data.startswith('\x89PNG')
@@ -0,0 +1,79 @@
+import json
+import numpy
+import pytest
+import time
+
+from flask import request
+
+import archive
+import packed
+
+from temperature import Temperature
+from test_utils import TestCollector
+
+class TestArchiveCodec():
+
+  def roundtrip(self, timestamps, values):
+    t, v = archive.decode(archive.encode(timestamps, values))
+
+    assert t.tolist() == timestamps
+    assert v.tolist() == values
+
+  def test_single_reading(self):
+    self.roundtrip([1000000000], [21.5])
+
+  def test_irregular_intervals(self):
+    self.roundtrip([1000000000, 1000000060, 1000000061, 1000000300, 1000003900], [20.0, 20.1, 20.1, 19.75, 22.0])
+
+  def test_negative_values(self):
+    self.roundtrip([1000000000, 1000000060, 1000000120, 1000000180], [-5.5, -0.25, 0.0, -12.0])
+
+class TestTemperatureArchive():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.app = self.collector.start()
+
+    # Old enough to be archived, recent enough to keep the raw readings
+    self.day = int(time.time()) - 10 * archive.DAY
+    self.day -= self.day % archive.DAY
+
+    readings = [
+      {"timestamp": self.day + 60, "reading": -3.5, "location": "balcony"},
+      {"timestamp": self.day + 100, "reading": 21, "location": "kitchen"},
+      {"timestamp": self.day + 3700, "reading": -1.25, "location": "balcony"},
+      {"timestamp": self.day + 7200, "reading": 4}
+    ]
+
+    self.app.post('/temperature/batch', data = json.dumps(readings), content_type = 'application/json')
+
+    flask = self.collector.collector
+    assert archive.seal(flask.shards.sessions[0], self.day) == 4
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def test_sealed(self):
+    db_session = self.collector.collector.shards.sessions[0]
+
+    assert db_session.execute("SELECT COUNT(*) FROM readings").scalar() == 0
+    assert db_session.execute("SELECT COUNT(*) FROM archive").scalar() == 3
+
+  def test_read_range(self):
+    flask = self.collector.collector
+
+    with flask.test_request_context('/temperature'):
+      timestamps, values, groups = Temperature(request).read_range(flask.db_session, self.day, self.day + 86399, ['balcony', 'kitchen'], 1)
+
+    assert timestamps.tolist() == [self.day + 60, self.day + 100, self.day + 3700]
+    assert values.tolist() == [-3.5, 21, -1.25]
+    assert groups.tolist() == [0, 1, 0]
+
+  def test_export(self):
+    r = self.app.get('/temperature?start=%d&end=%d&format=bin' % (self.day, self.day + 86399))
+
+    timestamps, values, locations = packed.decode(r.data)
+
+    assert timestamps.tolist() == [self.day + 7200, self.day + 3700, self.day + 100, self.day + 60]
+    assert values.tolist() == [4, -1.25, 21, -3.5]
+    assert locations.tolist() == [None, "balcony", "kitchen", "balcony"]
@@ -0,0 +1,88 @@
+import pytest
+
+from flask import json
+from test_utils import TestCollector
+
+class TestTemperatureBatch():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.app = self.collector.start()
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def post(self, readings):
+    r = self.app.post('/temperature/batch', data = json.dumps(readings), content_type = 'application/json')
+    return r, json.loads(r.data)
+
+  def test_no_list(self):
+    r, d = self.post({"reading": 12})
+
+    assert r.status_code == 400
+    assert d['message'] == "Invalid data"
+
+  def test_batch(self):
+    r, d = self.post([
+      {"timestamp": 1000, "reading": 12},
+      {"timestamp": 1060, "reading": 13, "location": "balcony"},
+      {"timestamp": 1120, "reading": 14}
+    ])
+
+    assert r.status_code == 200
+
+    assert d['accepted'] == 3
+    assert d['skipped'] == 0
+    assert d['rejected'] == 0
+
+  def test_skipped_and_rejected(self):
+    r, d = self.post([
+      {"timestamp": 1000, "reading": 12},
+      {"timestamp": 1060, "reading": 12.01},
+      {"timestamp": 1120, "reading": "warm"},
+      {"reading": 15}
+    ])
+
+    assert r.status_code == 200
+
+    assert d['accepted'] == 1
+    assert d['skipped'] == 1
+    assert d['rejected'] == 2
+
+  def test_duplicate_timestamps(self):
+    self.post([{"timestamp": 1000, "reading": 12}])
+
+    r, d = self.post([
+      {"timestamp": 1000, "reading": 20},
+      {"timestamp": 1060, "reading": 21}
+    ])
+
+    assert d['accepted'] == 1
+    assert d['skipped'] == 1
+
+  def test_location_not_string(self):
+    r, d = self.post([
+      {"timestamp": 1000, "reading": 12, "location": 5},
+      {"timestamp": 1060, "reading": 13, "location": ["balcony"]},
+      {"timestamp": 1120, "reading": 14, "location": "balcony"}
+    ])
+
+    assert r.status_code == 200
+
+    assert d['accepted'] == 1
+    assert d['rejected'] == 2
+
+  def test_out_of_range(self):
+    r = self.app.post('/temperature/batch', data = '''[
+      {"timestamp": -1, "reading": 12},
+      {"timestamp": 4294967296, "reading": 13},
+      {"timestamp": 1000, "reading": NaN},
+      {"timestamp": 1060, "reading": Infinity},
+      {"timestamp": 1120, "reading": 14}
+    ]''', content_type = 'application/json')
+    d = json.loads(r.data)
+
+    assert r.status_code == 200
+
+    assert d['accepted'] == 1
+    assert d['rejected'] == 4
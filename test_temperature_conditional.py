@@ -0,0 +1,44 @@
+import pytest
+
+from test_utils import TestCollector
+
+class TestTemperatureConditional():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.app = self.collector.start()
+
+    self.app.post('/temperature', data = '{"reading": 12}', content_type = 'application/json')
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def test_validators(self):
+    r = self.app.get('/temperature/last')
+
+    assert r.status_code == 200
+
+    assert r.headers.get('ETag')
+    assert r.headers.get('Last-Modified')
+
+  def test_if_none_match(self):
+    etag = self.app.get('/temperature/last').headers['ETag']
+    r = self.app.get('/temperature/last', headers = {'If-None-Match': etag})
+
+    assert r.status_code == 304
+    assert r.data == ""
+
+  def test_if_modified_since(self):
+    modified = self.app.get('/temperature/last').headers['Last-Modified']
+    r = self.app.get('/temperature/last', headers = {'If-Modified-Since': modified})
+
+    assert r.status_code == 304
+
+  def test_new_reading(self):
+    etag = self.app.get('/temperature/last').headers['ETag']
+
+    self.app.post('/temperature/batch', data = '[{"timestamp": 2000000000, "reading": 20}]', content_type = 'application/json')
+    r = self.app.get('/temperature/last', headers = {'If-None-Match': etag})
+
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
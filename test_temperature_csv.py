@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import json
+import pytest
+
+from test_utils import TestCollector
+
+class TestTemperatureCsv():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.app = self.collector.start()
+
+    readings = [
+      {"timestamp": 1000000000, "reading": 10.5, "location": u"küche"},
+      {"timestamp": 1000000100, "reading": 20.25}
+    ]
+
+    self.app.post('/temperature/batch', data = json.dumps(readings), content_type = 'application/json')
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def test_non_ascii_location(self):
+    r = self.app.get('/temperature?start=1000000000&end=1000000300&format=csv')
+
+    assert r.status_code == 200
+
+    lines = r.data.splitlines()
+
+    assert lines[0] == 'timestamp,value,location'
+    assert u'1000000000,10.5,küche'.encode('utf-8') in lines
@@ -0,0 +1,38 @@
+import json
+import pytest
+
+import packed
+
+from test_utils import TestCollector
+
+class TestTemperaturePacked():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.app = self.collector.start()
+
+    readings = [
+      {"timestamp": 1000000000, "reading": 10.5, "location": "balcony"},
+      {"timestamp": 1000000100, "reading": 20.25, "location": "kitchen"},
+      {"timestamp": 1000000200, "reading": 30}
+    ]
+
+    self.app.post('/temperature/batch', data = json.dumps(readings), content_type = 'application/json')
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def test_negotiated(self):
+    r = self.app.get('/temperature?start=1000000000&end=1000000300', headers = {'Accept': packed.MIME})
+
+    assert r.status_code == 200
+    assert r.headers['Content-Type'] == packed.MIME
+
+  def test_roundtrip(self):
+    r = self.app.get('/temperature?start=1000000000&end=1000000300&format=bin')
+
+    timestamps, values, locations = packed.decode(r.data)
+
+    assert timestamps.tolist() == [1000000200, 1000000100, 1000000000]
+    assert values.tolist() == [30, 20.25, 10.5]
+    assert locations.tolist() == [None, "kitchen", "balcony"]
@@ -0,0 +1,79 @@
+import json
+import os
+import pstats
+import shutil
+import tempfile
+
+import profiling
+
+from test_utils import TestCollector
+
+class TestTemperatureProfile():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.path = tempfile.mkdtemp()
+
+    profiling.Profiler(self.path, 2, 0.0, 'secret').install(self.collector.collector, ['temperature'])
+
+    self.app = self.collector.start()
+
+    readings = [{"timestamp": 1000000000 + i * 60, "reading": i, "location": "balcony"} for i in range(100)]
+
+    self.app.post('/temperature/batch', data = json.dumps(readings), content_type = 'application/json')
+
+  def teardown_method(self, method):
+    self.collector.stop()
+    shutil.rmtree(self.path)
+
+  def get(self, args, signature = None):
+    args = dict(args, profile = '1')
+    args['signature'] = signature or profiling.sign('secret', '/temperature', args)
+
+    return self.app.get('/temperature', query_string = args)
+
+  def profiles(self):
+    return sorted(os.listdir(self.path))
+
+  def test_signed(self):
+    r = self.get({'start': '1000000000', 'end': '1000005999', 'format': 'svg'})
+
+    assert r.status_code == 200
+
+    profiles = self.profiles()
+
+    assert len(profiles) == 1
+    assert profiles[0].endswith('-temperature-get-1000000000-1000005999-100rows-svg.prof')
+
+    # Rendered in the request thread, not in a worker process
+    stats = pstats.Stats(os.path.join(self.path, profiles[0]))
+
+    assert any('matplotlib' in f[0] for f in stats.stats)
+
+  def test_bad_signature(self):
+    r = self.get({'start': '1000000000', 'end': '1000005999', 'format': 'svg'}, 'bad')
+
+    assert r.status_code == 200
+    assert self.profiles() == []
+
+  def test_rotation(self):
+    for end in ['1000001999', '1000003999', '1000005999']:
+      self.get({'start': '1000000000', 'end': end, 'format': 'svg'})
+
+    profiles = self.profiles()
+
+    assert len(profiles) == 2
+    assert '-1000003999-' in profiles[0]
+    assert '-1000005999-' in profiles[1]
+
+  def test_streamed(self):
+    r = self.get({'start': '1000000000', 'end': '1000005999', 'format': 'csv'})
+
+    assert self.profiles() == []
+
+    r.data
+
+    profiles = self.profiles()
+
+    assert len(profiles) == 1
+    assert profiles[0].endswith('-100rows-csv.prof')
@@ -41,3 +41,10 @@ class TestTemperatureSave():
     assert d['value'] == 12.2
     assert d['location'] == "balcony"
 
+
+  def test_location_not_string(self):
+    r = self.app.post('/temperature', data = '{"reading": 12, "location": 5}', content_type = 'application/json')
+    d = json.loads(r.data)
+
+    assert r.status_code == 400
+    assert d['description'] == "Parameter 'location' accepts only strings"
@@ -0,0 +1,41 @@
+import pytest
+import time
+
+from test_utils import TestCollector
+
+class TestTemperatureSparkline():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.app = self.collector.start()
+
+    now = int(time.time())
+
+    self.app.post('/temperature/batch', data = '[{"timestamp": %d, "reading": 12}, {"timestamp": %d, "reading": 15}]' % (now - 600, now - 300), content_type = 'application/json')
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def test_png(self):
+    r = self.app.get('/temperature?style=sparkline&w=100&h=20&format=png')
+
+    assert r.status_code == 200
+    assert r.headers['Content-Type'] == 'image/png'
+    assert r.data.startswith('\x89PNG')
+
+  def test_svg(self):
+    r = self.app.get('/temperature?style=sparkline&format=svg')
+
+    assert r.status_code == 200
+    assert 'width="200" height="40"' in r.data
+    assert '<path d="M' in r.data
+
+  def test_invalid_size(self):
+    r = self.app.get('/temperature?style=sparkline&w=0&format=png')
+
+    assert r.status_code == 400
+
+  def test_unsupported_format(self):
+    r = self.app.get('/temperature?style=sparkline&format=pdf')
+
+    assert r.status_code == 400
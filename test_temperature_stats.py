@@ -0,0 +1,50 @@
+import json
+import pytest
+
+from test_utils import TestCollector
+
+class TestTemperatureStats():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.app = self.collector.start()
+
+    readings = [
+      {"timestamp": 1000000000, "reading": 10, "location": "balcony"},
+      {"timestamp": 1000000100, "reading": 20, "location": "balcony"},
+      {"timestamp": 1000000200, "reading": 30, "location": "kitchen"},
+      {"timestamp": 1000090000, "reading": 15, "location": "balcony"}
+    ]
+
+    self.app.post('/temperature/batch', data = json.dumps(readings), content_type = 'application/json')
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def test_daily_stats(self):
+    r = self.app.get('/temperature/stats?start=999993600&end=1000166399&percentiles=50')
+
+    assert r.status_code == 200
+
+    stats = json.loads(r.data)['stats']
+
+    assert len(stats) == 2
+    assert stats[0]['min'] == 10
+    assert stats[0]['max'] == 30
+    assert stats[0]['mean'] == 20
+    assert stats[0]['count'] == 3
+    assert stats[0]['percentiles']['50'] == 20
+    assert stats[1]['count'] == 1
+
+  def test_location(self):
+    r = self.app.get('/temperature/stats?start=999993600&end=1000079999&location=kitchen')
+
+    stats = json.loads(r.data)['stats']
+
+    assert stats[0]['count'] == 1
+    assert stats[0]['max'] == 30
+
+  def test_too_many_buckets(self):
+    r = self.app.get('/temperature/stats?start=999993600&end=1000166399&bucket=1')
+
+    assert r.status_code == 400
@@ -1,7 +1,7 @@
 import os
 import tempfile
 
-from application import Collector
+from collector import Collector
 
 class TestCollector:
     def __init__(self):
@@ -13,9 +13,19 @@ class TestCollector:
         self.db_fd, self.collector.config['DATABASE'] = tempfile.mkstemp()
 
         self.collector.init_db()
+        self.collector.renderer.start()
+        self.collector.start_threads()
 
         return self.collector.test_client()
 
     def stop(self):
+        self.collector.renderer.stop()
+
+        if self.collector.writer:
+            self.collector.writer.stop()
+
+        if self.collector.compactor:
+            self.collector.compactor.stop()
+
         os.close(self.db_fd)
         os.unlink(self.collector.config['DATABASE'])
@@ -0,0 +1,91 @@
+import numpy
+import pytest
+
+from window import RingBuffer, HotWindow
+
+class TestRingBuffer():
+
+  def data(self, buffer):
+    timestamps, values = buffer.data()
+    return timestamps.tolist(), values.tolist()
+
+  def test_append(self):
+    b = RingBuffer(4, 0)
+
+    for t in [10, 20, 30]:
+      b.append(t, t / 10.0)
+
+    assert self.data(b) == ([10, 20, 30], [1, 2, 3])
+    assert b.since == 0
+
+  def test_wrap(self):
+    b = RingBuffer(3, 0)
+
+    for t in [10, 20, 30, 40, 50]:
+      b.append(t, t / 10.0)
+
+    assert self.data(b) == ([30, 40, 50], [3, 4, 5])
+    # The readings before 30 were overwritten
+    assert b.since == 21
+
+  def test_out_of_order(self):
+    b = RingBuffer(4, 0)
+
+    for t in [10, 30, 20, 40]:
+      b.append(t, t / 10.0)
+
+    assert self.data(b) == ([10, 20, 30, 40], [1, 2, 3, 4])
+
+    b.append(25, 2.5)
+
+    assert self.data(b) == ([20, 25, 30, 40], [2, 2.5, 3, 4])
+    assert b.since == 11
+
+class TestHotWindow():
+
+  def setup_method(self, method):
+    self.window = HotWindow(1000, 10)
+    self.window.since = 5000
+
+  def update(self, *readings):
+    self.window.update([{'time': t, 'reading': v, 'location': l} for t, v, l in readings])
+
+  def test_not_loaded(self):
+    window = HotWindow(1000, 10)
+    window.update([{'time': 5000, 'reading': 1, 'location': None}])
+
+    assert not window.covers(5000)
+
+  def test_empty(self):
+    assert not self.window.covers(5000)
+
+  def test_covers(self):
+    self.update((5100, 1, 'balcony'), (5200, 2, 'kitchen'))
+
+    assert self.window.covers(5000)
+    assert self.window.covers(5000, ['balcony'])
+    assert not self.window.covers(4999)
+
+  def test_covers_overwritten(self):
+    self.update((5100, 1, 'kitchen'))
+    self.update(*[(5100 + i, i, 'balcony') for i in range(20)])
+
+    assert self.window.covers(5200, ['balcony'])
+    assert not self.window.covers(5100, ['balcony'])
+    assert self.window.covers(5100, ['kitchen'])
+    assert not self.window.covers(5100)
+
+  def test_read(self):
+    self.update((5100, 1, 'balcony'), (5150, 3, 'kitchen'), (5200, 2, 'balcony'), (4000, 0, 'balcony'))
+
+    timestamps, values, groups = self.window.read(5000, 5200, ['kitchen', 'balcony'])
+
+    assert timestamps.tolist() == [5100, 5150, 5200]
+    assert values.tolist() == [1, 3, 2]
+    assert groups.tolist() == [1, 0, 1]
+
+  def test_clear(self):
+    self.update((5100, 1, None))
+    self.window.clear()
+
+    assert not self.window.covers(5000)
@@ -0,0 +1,138 @@
+import threading
+
+import pytest
+
+from flask import json
+from metrics import registry
+from test_utils import TestCollector
+
+def counter(name):
+  return registry.counters.get((name, ()), 0)
+
+class TestWriteBehind():
+
+  def setup_method(self, method):
+    self.collector = TestCollector()
+    self.flask = self.collector.collector
+
+    self.flask.config['WRITE_BEHIND'] = True
+    self.flask.config['WRITE_BEHIND_BATCH'] = 3
+    self.flask.config['WRITE_BEHIND_INTERVAL'] = 0.2
+    self.flask.config['WRITE_BEHIND_QUEUE'] = 1
+    self.flask.config['WRITE_BEHIND_TIMEOUT'] = 0.1
+
+    self.app = self.collector.start()
+    self.writer = self.flask.writer
+
+    # The readings of the calls of shards.insert
+    self.batches = []
+    self.insert = self.flask.shards.insert
+
+    def insert(readings, *args):
+      self.batches.append([r['time'] for r in readings])
+      return self.insert(readings, *args)
+
+    self.flask.shards.insert = insert
+
+  def teardown_method(self, method):
+    self.collector.stop()
+
+  def put(self, *timestamps):
+    for t in timestamps:
+      self.writer.put({'time': t, 'reading': t / 10.0, 'location': None})
+
+  def stored(self):
+    return [r[0] for r in self.flask.db_session.execute("SELECT timestamp FROM readings ORDER BY timestamp")]
+
+  def test_batches(self):
+    self.writer.interval = 0.5
+    self.writer.queue.maxsize = 0
+
+    self.put(*range(1000, 1007))
+    self.writer.stop()
+
+    assert self.stored() == range(1000, 1007)
+    assert max(len(b) for b in self.batches) == 3
+    assert sum(self.batches, []) == range(1000, 1007)
+
+  def test_drain_on_stop(self):
+    # Not stored before the interval is over
+    self.writer.interval = 1
+    self.writer.queue.maxsize = 0
+
+    self.put(1000, 1010)
+    self.writer.stop()
+
+    assert self.stored() == [1000, 1010]
+    assert self.writer.queue.empty()
+
+  def test_full_queue(self):
+    taken = threading.Event()
+    release = threading.Event()
+
+    def insert(readings, *args):
+      taken.set()
+      release.wait()
+      return self.insert(readings, *args)
+
+    self.flask.shards.insert = insert
+    self.writer.batch_size = 1
+
+    # The writer holds the first reading, the second fills the queue
+    self.put(1000)
+    taken.wait(5)
+    self.put(1010)
+
+    r = self.app.post('/temperature', data = '{"reading": 12}', content_type = 'application/json')
+    d = json.loads(r.data)
+
+    assert r.status_code == 503
+    assert d['message'] == "Server busy"
+    assert 'Retry-After' in r.headers
+
+    release.set()
+    self.writer.stop()
+
+    assert self.stored() == [1000, 1010]
+
+  def test_retry(self):
+    failures = counter('write_behind_failures_total')
+    lost = counter('write_behind_lost_total')
+
+    def insert(readings, *args):
+      self.batches.append([r['time'] for r in readings])
+
+      if len(self.batches) == 1:
+        raise IOError("database is locked")
+
+      return self.insert(readings, *args)
+
+    self.flask.shards.insert = insert
+
+    self.put(1000)
+    self.writer.stop()
+
+    assert self.stored() == [1000]
+    assert self.batches == [[1000], [1000]]
+    assert counter('write_behind_failures_total') == failures + 1
+    assert counter('write_behind_lost_total') == lost
+
+  def test_lost(self):
+    lost = counter('write_behind_lost_total')
+
+    def insert(readings, *args):
+      if 1010 in [r['time'] for r in readings]:
+        raise ValueError("bad reading")
+
+      return self.insert(readings, *args)
+
+    self.flask.shards.insert = insert
+    self.writer.interval = 0.01
+    self.writer.queue.maxsize = 0
+
+    self.put(1000, 1010, 1020)
+
+    self.writer.stop()
+
+    assert self.stored() == [1000, 1020]
+    assert counter('write_behind_lost_total') == lost + 1
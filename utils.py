@@ -3,26 +3,41 @@ import time
 from logging import getLogger, StreamHandler, Formatter, getLoggerClass, DEBUG
 import logging
 
+import metrics
+
 class Timer():
     """
-    Simple class to measure time of execution
+    Simple class to measure time of execution.
+    When a metric name is given, the duration (in seconds) is also
+    added to the histogram with that name and given labels.
     """
 
+    def __init__(self, metric = None, **labels):
+        self.metric = metric
+        self.labels = labels
+
     def __enter__(self):
-        self.start_time = time.clock()
+        # Wall clock time; time.clock() measures the CPU time of the
+        # process on Unix, which misses the waits for the database
+        self.start_time = time.time()
         return self
 
     def __exit__(self, type, value, traceback):
-        self.end_time = time.clock()
-#        raise traceback
+        self.end_time = time.time()
+
+        if self.metric and type is None:
+            metrics.registry.observe(self.metric, self.seconds(), **self.labels)
+
+    def seconds(self):
+        return self.end_time - self.start_time
 
     def miliseconds(self):
-        return int((self.end_time - self.start_time) * 1000)
+        return int(self.seconds() * 1000)
 
 
 def init_logging(app):
 
-    loggers = [app.logger, getLogger('sqlalchemy')] #, getLogger('sqlalchemy.engine')]
+    loggers = [app.logger, getLogger('sqlalchemy'), getLogger('graph')] #, getLogger('sqlalchemy.engine')]
 
     handler = StreamHandler()
     handler.setFormatter(Formatter('%(asctime)s %(levelname)s\t%(filename)s:%(lineno)d: %(message)s'))
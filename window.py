@@ -0,0 +1,190 @@
+import threading
+import time
+
+import numpy
+
+class RingBuffer:
+    """
+    Fixed-size arrays holding the newest readings of a location,
+    oldest first; when full, the oldest reading is overwritten.
+    """
+
+    def __init__(self, size, since):
+        self.timestamps = numpy.zeros(size, dtype = numpy.int64)
+        self.values = numpy.zeros(size, dtype = numpy.float64)
+
+        # Index of the next write and the number of readings held
+        self.head = 0
+        self.count = 0
+
+        # All the readings of the location since this timestamp are held
+        self.since = since
+
+    def data(self):
+        """ Returns copies of the timestamps and values, oldest first """
+
+        if self.count < len(self.timestamps):
+            return self.timestamps[:self.count].copy(), self.values[:self.count].copy()
+
+        return numpy.r_[self.timestamps[self.head:], self.timestamps[:self.head]], numpy.r_[self.values[self.head:], self.values[:self.head]]
+
+    def reset(self, timestamps, values):
+        """ Replaces the content by the readings (sorted by time), keeping the newest ones that fit """
+
+        size = len(self.timestamps)
+
+        if len(timestamps) > size:
+            self.since = max(self.since, int(timestamps[-size - 1]) + 1)
+            timestamps, values = timestamps[-size:], values[-size:]
+
+        self.timestamps[:len(timestamps)] = timestamps
+        self.values[:len(values)] = values
+
+        self.count = len(timestamps)
+        self.head = self.count % size
+
+    def append(self, timestamp, value):
+        if self.count and timestamp < self.timestamps[self.head - 1]:
+            # Readings replayed out of order are rare; sort them in
+            timestamps, values = self.data()
+            i = numpy.searchsorted(timestamps, timestamp, 'right')
+
+            self.reset(numpy.insert(timestamps, i, timestamp), numpy.insert(values, i, value))
+            return
+
+        if self.count == len(self.timestamps):
+            self.since = max(self.since, int(self.timestamps[self.head]) + 1)
+        else:
+            self.count += 1
+
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+
+        self.head = (self.head + 1) % len(self.timestamps)
+
+class HotWindow:
+    """
+    The readings of the last span seconds kept in memory, in a ring
+    buffer of given size per location, so the graphs of recent ranges
+    (the default 24 hours) don't need to query the database.
+    """
+
+    def __init__(self, span, size):
+        self.span = span
+        self.size = size
+
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+        # Readings since this timestamp were loaded or added; None until loaded
+        self.since = None
+
+    def load(self, db_session, store = None, now = None):
+        """
+        Adds the readings of the last span seconds from the database (or
+        the store) to the buffers; called once for every shard.
+        """
+
+        since = (now or int(time.time())) - self.span
+
+        if store:
+            timestamps, values, indexes = store.read(since, 2 ** 31)
+            locations = store.names(indexes)
+        else:
+            result = db_session.execute("SELECT timestamp, value, location FROM readings WHERE timestamp >= :since ORDER BY timestamp", {'since': since}).fetchall()
+
+            timestamps = numpy.array([r[0] for r in result], dtype = numpy.int64)
+            values = numpy.array([r[1] for r in result], dtype = numpy.float64)
+            locations = numpy.array([r[2] for r in result], dtype = object)
+
+        # Number every location, so the readings can be split with NumPy
+        numbers = {}
+        keys = numpy.array([numbers.setdefault(l, len(numbers)) for l in locations.tolist()], dtype = int)
+
+        with self.lock:
+            self.since = max(since, self.since)
+
+            for location, key in numbers.items():
+                selected = keys == key
+                t, v = timestamps[selected], values[selected]
+
+                if location in self.buffers:
+                    # A location moved to another shard has readings in both
+                    held = self.buffers[location].data()
+                    t, v = numpy.r_[held[0], t], numpy.r_[held[1], v]
+
+                    order = numpy.argsort(t, kind = 'mergesort')
+                    t, v = t[order], v[order]
+                else:
+                    self.buffers[location] = RingBuffer(self.size, since)
+
+                self.buffers[location].reset(t, v)
+
+    def update(self, readings):
+        """ Adds the readings just stored """
+
+        with self.lock:
+            if self.since is None:
+                return
+
+            for r in readings:
+                if r['time'] < self.since:
+                    continue
+
+                if r['location'] not in self.buffers:
+                    self.buffers[r['location']] = RingBuffer(self.size, self.since)
+
+                self.buffers[r['location']].append(r['time'], r['reading'])
+
+    def clear(self):
+        """ Drops all the readings; load them again afterwards """
+
+        with self.lock:
+            self.buffers = {}
+            self.since = None
+
+    def covers(self, start, locations = None):
+        """
+        Returns True if all the readings since start (of the locations)
+        are held. Readings stored bypassing update are missed; whoever
+        stores them so has to clear and load the window again.
+        """
+
+        with self.lock:
+            if self.since is None or start < self.since or not self.buffers:
+                return False
+
+            buffers = [self.buffers[l] for l in (locations or self.buffers) if l in self.buffers]
+
+            return all(start >= b.since for b in buffers)
+
+    def read(self, start, end, locations = None):
+        """
+        Returns the timestamps, values and series numbers (positions of
+        the locations in the list, or 0 without locations) of the readings
+        between start and end, oldest first.
+        """
+
+        parts = []
+
+        with self.lock:
+            if locations:
+                buffers = [(i, self.buffers[l]) for i, l in enumerate(locations) if l in self.buffers]
+            else:
+                buffers = [(0, b) for b in self.buffers.values()]
+
+            for i, b in buffers:
+                timestamps, values = b.data()
+
+                first = numpy.searchsorted(timestamps, start, 'left')
+                last = numpy.searchsorted(timestamps, end, 'right')
+
+                parts.append((timestamps[first:last], values[first:last], numpy.repeat(i, last - first)))
+
+        if not parts:
+            return numpy.empty(0, numpy.int64), numpy.empty(0, numpy.float64), numpy.empty(0, int)
+
+        timestamps, values, groups = [numpy.concatenate(c) for c in zip(*parts)]
+        order = numpy.argsort(timestamps, kind = 'mergesort')
+
+        return timestamps[order], values[order], groups[order]
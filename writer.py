@@ -0,0 +1,139 @@
+import collections
+import Queue
+import threading
+import time
+
+import ingest
+
+from errors import OverloadException
+from ingest import LatestReadings
+from metrics import registry
+
+# Number of times a batch is stored again after a failure, before it's dropped
+RETRIES = 3
+
+class WriteBehind(threading.Thread):
+    """
+    Stores readings in the background.
+
+    Accepted readings are put on a bounded queue and a single writer
+    thread stores them in batches, one transaction per batch. A batch
+    is written when it has batch_size readings or after interval seconds.
+    When the queue is full, putting a reading waits up to timeout seconds
+    and then fails with 503.
+    """
+
+    def __init__(self, app, batch_size, interval, queue_size, timeout):
+        threading.Thread.__init__(self, name = 'write-behind')
+        self.daemon = True
+
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+
+        self.queue = Queue.Queue(queue_size)
+        self.stopping = threading.Event()
+
+        # Newest accepted reading per location, including the ones not stored yet
+        self.accepted = LatestReadings()
+
+    def put(self, reading, block = True, source = None):
+        """
+        Queues the reading; without block a full queue fails right away.
+        The readings of a named source are counted once stored, in the
+        <source>_readings_total metric, or in <source>_duplicates_total
+        when skipped for a taken timestamp.
+        """
+
+        try:
+            self.queue.put((reading, source), block, self.timeout)
+        except Queue.Full:
+            raise OverloadException("Server busy", "Too many readings are waiting to be stored; try again later", 1)
+
+        self.accepted.update([reading])
+
+    def last(self, location):
+        """ Returns the newest accepted reading for the location, stored or not """
+
+        return self.accepted.get(location) or self.app.latest.get(location)
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = self.collect()
+
+            if batch:
+                self.flush(batch)
+
+    def collect(self):
+        batch = []
+        deadline = time.time() + self.interval
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(timeout = remaining))
+            except Queue.Empty:
+                break
+
+        return batch
+
+    def flush(self, batch):
+        """
+        Stores the batch, retrying it RETRIES times after a failure (the
+        readings of the shards committed already are skipped as taken).
+        If it still fails, the readings are stored one by one, so a bad
+        reading doesn't take the rest of the batch down with it.
+        """
+
+        for attempt in xrange(RETRIES + 1):
+            if self.store(batch):
+                return
+
+            time.sleep(self.interval)
+
+        lost = [item for item in batch if not self.store([item])]
+
+        registry.inc('write_behind_lost_total', len(lost))
+
+        # Don't reject the next readings of the locations as duplicates of the lost ones
+        self.accepted.forget([r for r, source in lost])
+
+    def store(self, batch):
+        """ Stores the batch in a transaction per shard; returns False if it failed """
+
+        try:
+            stored = self.app.shards.insert([r for r, source in batch], self.app.stored, self.app.store)
+
+            self.app.logger.debug("Stored %d of %d queued readings", len(stored), len(batch))
+
+            self.count(batch, stored)
+            return True
+        except:
+            registry.inc('write_behind_failures_total')
+            self.app.logger.exception("Storing %d queued readings failed", len(batch))
+
+            return False
+        finally:
+            self.app.shards.remove()
+
+    def count(self, batch, stored):
+        stored = set(id(r) for r in stored)
+        counts = collections.Counter()
+
+        for r, source in batch:
+            if source:
+                counts[source + ('_readings_total' if id(r) in stored else '_duplicates_total')] += 1
+
+        for name, count in counts.items():
+            registry.inc(name, count)
+
+    def stop(self):
+        """ Stores all the pending readings and stops the thread """
+
+        self.stopping.set()
+        self.join()